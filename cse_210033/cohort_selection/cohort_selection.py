@@ -1,16 +1,20 @@
-from typing import Dict, List
+from typing import Any, Dict, List
 
 from edsteva.utils.framework import is_koalas
 from edsteva.utils.typing import Data, DataFrame
 
+from .utils import outcome_enrichments, outcome_sources
 from .utils.add_events import add_patient_info
 from .utils.filter_events import (
     clean_date,
+    filter_cohort_person,
     filter_date,
     filter_event,
     filter_first_event,
-    filter_note_type,
+    get_cohort_person,
+    tag_events,
 )
+from .utils.outcomes import OUTCOME_STEPS, plan_outcomes
 from .utils.prepare_df import (
     prepare_care_site,
     prepare_condition_occurrence,
@@ -37,18 +41,12 @@ def cohort_selection(
     cmd: Dict[str, List[str]],
     hospit_stay_type_regex: str,
     hospit_stay_source_regex: str,
-    emergency_stay_type_regex: str,
-    emergency_stay_source_regex: str,
-    consultation_note_type_regex: str,
-    prescription_note_type_regex: str,
     condition_transfer_type_regex: str,
     diag_regex: List[str],
-    bronchiolite_regex: str,
-    flu_regex: str,
-    gastroenteritis_regex: str,
-    nasopharyngitis_regex: str,
-    icu_regex: str,
+    outcomes: Dict[str, Dict[str, Any]],
+    cohort_person_broadcast_threshold: int = 5000000,
 ) -> Dict[str, DataFrame]:
+    outcomes_conf = outcomes
     outcomes = {}
     # Table Extraction
     care_site = prepare_care_site(data=data)
@@ -67,9 +65,13 @@ def cohort_selection(
     )
     note = prepare_note(data=data, note_source_system=note_source_system)
     note_care_site = prepare_note_care_site(extra_data=prod_data, care_site=care_site)
-    condition_detail = visit_detail[
-        visit_detail.transfer_type == condition_transfer_type_regex
-    ].drop(columns="visit_occurrence_id")
+    condition_detail = (
+        visit_detail[visit_detail.transfer_type == condition_transfer_type_regex].drop(
+            columns="visit_occurrence_id"
+        )
+        if condition_source_system == "ORBIS"
+        else None
+    )
     # Cohort visit
     cohort_visit = filter_event(
         df=visit_occurrence,
@@ -99,246 +101,41 @@ def cohort_selection(
     # Store result
     outcomes["cohort_visit"] = cohort_visit
 
-    # Outcome 1 : hospit visit after cohort stay
-    # Filter event
-    hospit_visit = filter_event(
-        df=visit_occurrence,
-        col_to_filter="stay_type",
-        event_regex=hospit_stay_type_regex,
-    )
-    hospit_visit = filter_event(
-        df=hospit_visit,
-        col_to_filter="stay_source",
-        event_regex=hospit_stay_source_regex,
-    )
-    # Filter on cohort patients
-    hospit_visit = hospit_visit[
-        [
-            "visit_occurrence_id",
-            "person_id",
-            "care_site_id",
-            "visit_start_datetime",
-        ]
-    ].merge(cohort_visit[["person_id"]].drop_duplicates(), on="person_id")
-    # Store result
-    outcomes["hospit_visit"] = hospit_visit
-
-    # Outcome 2 : emergency visit after cohort stay
-    # Filter event
-    emergency_visit = filter_event(
-        df=visit_occurrence,
-        col_to_filter="stay_type",
-        event_regex=emergency_stay_type_regex,
-    )
-    emergency_visit = filter_event(
-        df=emergency_visit,
-        col_to_filter="stay_source",
-        event_regex=emergency_stay_source_regex,
-    )
-    # Filter on cohort patients
-    emergency_visit = emergency_visit[
-        [
-            "visit_occurrence_id",
-            "person_id",
-            "care_site_id",
-            "visit_start_datetime",
-        ]
-    ].merge(cohort_visit[["person_id"]].drop_duplicates(), on="person_id")
-    # Store result
-    outcomes["emergency_visit"] = emergency_visit
-
-    # Outcome 3: consultation doc after cohort stay
-    # Filter event
-    consultation_note = filter_note_type(
-        note=note, note_type_regex=consultation_note_type_regex
-    )
-    # Keep one note per visit
-    consultation_note = filter_first_event(
-        df=consultation_note, col_date="note_datetime"
-    )
-    # Clean date
-    consultation_note = clean_date(df=consultation_note, col_date="note_datetime")
-    # Filter on cohort patients
-    consultation_note = consultation_note[
-        [
-            "person_id",
-            "visit_occurrence_id",
-            "note_datetime",
-            "note_id",
-            "note_type",
-        ]
-    ].merge(cohort_visit[["person_id"]].drop_duplicates(), on="person_id")
-    # Add detail_care_site_id
-    consultation_note = consultation_note.merge(
-        note_care_site,
-        on="note_id",
-    ).drop(columns="note_id")
-    # Add care_site_id
-    consultation_note = consultation_note.merge(
-        visit_occurrence[
-            [
-                "visit_occurrence_id",
-                "care_site_id",
-                "visit_start_datetime",
-            ]
-        ],
-        on="visit_occurrence_id",
-        how="left",
-    )
-    # Store result
-    outcomes["consultation_note"] = consultation_note
-
-    # Outcome 4: prescription doc during hospitalization
-    # Filter event
-    prescription_note = filter_note_type(
-        note=note, note_type_regex=prescription_note_type_regex
-    )
-    # Keep one note per visit
-    prescription_note = filter_first_event(
-        df=prescription_note, col_date="note_datetime"
+    # Outcomes
+    tables = dict(
+        care_site=care_site,
+        visit_occurrence=visit_occurrence,
+        visit_detail=visit_detail,
+        condition_occurrence=condition_occurrence,
+        note=note,
+        note_care_site=note_care_site,
+        condition_detail=condition_detail,
     )
-    # Clean date
-    prescription_note = clean_date(df=prescription_note, col_date="note_datetime")
-    # Filter on cohort visits
-    prescription_note = (
-        cohort_visit[
-            [
-                "visit_cohort_id",
-                "care_site_id",
-                "cohort_stay_start",
-            ]
-        ]
-        .rename(
-            columns={
-                "visit_cohort_id": "visit_occurrence_id",
-            }
-        )
-        .drop_duplicates()
-        .merge(
-            prescription_note[
-                [
-                    "person_id",
-                    "visit_occurrence_id",
-                    "note_datetime",
-                    "note_type",
-                    "note_id",
-                ]
-            ],
-            on="visit_occurrence_id",
+    outcomes.update(
+        select_outcomes(
+            outcomes=outcomes_conf,
+            tables=tables,
+            cohort_visit=cohort_visit,
+            cohort_person_broadcast_threshold=cohort_person_broadcast_threshold,
         )
     )
-    # Add detail_care_site_id
-    prescription_note = prescription_note.merge(
-        note_care_site,
-        on="note_id",
-    ).drop(columns="note_id")
-    # Store result
-    outcomes["prescription_note"] = prescription_note
 
-    # Outcome 5: icu visit after cohort stay
-    # Filter event
-    icu_care_site = filter_event(
-        df=care_site,
-        col_to_filter="service_type",
-        event_regex=icu_regex,
-    )[["care_site_id", "service_type"]].rename(
-        columns={
-            "care_site_id": "detail_care_site_id",
-        }
-    )
-    icu_visit = (
-        visit_occurrence[
-            [
-                "visit_occurrence_id",
-                "person_id",
-                "care_site_id",
-                "visit_start_datetime",
-                "stay_type",
-            ]
-        ]
-        .merge(
-            visit_detail,
-            on="visit_occurrence_id",
-            how="inner",
-        )
-        .merge(
-            icu_care_site,
-            on="detail_care_site_id",
-            how="inner",
-        )
-    )
-    # Filter on cohort patients
-    icu_visit = icu_visit.merge(
-        cohort_visit[["person_id"]].drop_duplicates(), on="person_id"
-    )
-    # Keep one ICU per visit
-    icu_visit = filter_first_event(df=icu_visit, col_date="visit_detail_start_datetime")
-    # Store result
-    outcomes["icu_visit"] = icu_visit
+    return outcomes
 
-    # Outcome 6: bronchiolitis condition during hospitalization
-    # Filter event
-    bronchiolitis_condition = filter_event(
-        df=condition_occurrence,
-        col_to_filter="condition_source_value",
-        event_regex=bronchiolite_regex,
-    )
-    # Keep one condition per visit
-    bronchiolitis_condition = filter_first_event(
-        df=bronchiolitis_condition, col_date="condition_start_datetime"
-    )
-    # Filter on cohort visits
-    bronchiolitis_condition = (
-        cohort_visit[
-            [
-                "person_id",
-                "visit_cohort_id",
-                "care_site_id",
-                "cohort_stay_start",
-            ]
-        ]
-        .rename(
-            columns={
-                "visit_cohort_id": "visit_occurrence_id",
-            }
-        )
-        .drop_duplicates()
-        .merge(
-            bronchiolitis_condition[
-                [
-                    "visit_occurrence_id",
-                    "visit_detail_id",
-                    "diag_type",
-                    "condition_source_value",
-                    "condition_start_datetime",
-                ]
-            ],
-            on="visit_occurrence_id",
-        )
-    )
-    # Add detail_care_site_id
-    if condition_source_system == "ORBIS":
-        bronchiolitis_condition = bronchiolitis_condition.merge(
-            condition_detail,
-            on="visit_detail_id",
-            how="left",
-        )
-    # Store result
-    outcomes["bronchiolitis_condition"] = bronchiolitis_condition
 
-    # Outcome 7: flu condition during hospitalization
-    # Filter event
-    flu_condition = filter_event(
-        df=condition_occurrence,
-        col_to_filter="condition_source_value",
-        event_regex=flu_regex,
-    )
-    # Keep one condition per visit
-    flu_condition = filter_first_event(
-        df=flu_condition, col_date="condition_start_datetime"
+def select_outcomes(
+    outcomes: Dict[str, Dict[str, Any]],
+    tables: Dict[str, DataFrame],
+    cohort_visit: DataFrame,
+    cohort_person_broadcast_threshold: int = 5000000,
+    col_tag: str = "outcome_name",
+) -> Dict[str, DataFrame]:
+    # Shared cohort keys
+    cohort_person = get_cohort_person(
+        cohort_visit=cohort_visit,
+        broadcast_threshold=cohort_person_broadcast_threshold,
     )
-    # Filter on cohort visits
-    flu_condition = (
+    cohort_stay = (
         cohort_visit[
             [
                 "person_id",
@@ -353,127 +150,71 @@ def cohort_selection(
             }
         )
         .drop_duplicates()
-        .merge(
-            flu_condition[
-                [
-                    "visit_occurrence_id",
-                    "visit_detail_id",
-                    "diag_type",
-                    "condition_source_value",
-                    "condition_start_datetime",
-                ]
-            ],
-            on="visit_occurrence_id",
-        )
     )
-    # Add detail_care_site_id
-    if condition_source_system == "ORBIS":
-        flu_condition = flu_condition.merge(
-            condition_detail,
-            on="visit_detail_id",
-            how="left",
-        )
-    # Store result
-    outcomes["flu_condition"] = flu_condition
 
-    # Outcome 8: gastroenteritis condition during hospitalization
-    # Filter event
-    gastroenteritis_condition = filter_event(
-        df=condition_occurrence,
-        col_to_filter="condition_source_value",
-        event_regex=gastroenteritis_regex,
-    )
-    # Keep one condition per visit
-    gastroenteritis_condition = filter_first_event(
-        df=gastroenteritis_condition, col_date="condition_start_datetime"
-    )
-    # Filter on cohort visits
-    gastroenteritis_condition = (
-        cohort_visit[
-            [
-                "person_id",
-                "visit_cohort_id",
-                "care_site_id",
-                "cohort_stay_start",
-            ]
-        ]
-        .rename(
-            columns={
-                "visit_cohort_id": "visit_occurrence_id",
-            }
-        )
-        .drop_duplicates()
-        .merge(
-            gastroenteritis_condition[
-                [
-                    "visit_occurrence_id",
-                    "visit_detail_id",
-                    "diag_type",
-                    "condition_source_value",
-                    "condition_start_datetime",
-                ]
-            ],
-            on="visit_occurrence_id",
-        )
-    )
-    # Add detail_care_site_id
-    if condition_source_system == "ORBIS":
-        gastroenteritis_condition = gastroenteritis_condition.merge(
-            condition_detail,
-            on="visit_detail_id",
-            how="left",
-        )
-    # Store result
-    outcomes["gastroenteritis_condition"] = gastroenteritis_condition
+    selected_outcomes = {}
+    for source_name, groups in plan_outcomes(outcomes).items():
+        # Extract each source table once and filter on cohort patients
+        source = outcome_sources.get(source_name)(tables=tables)
+        if "person_id" in source.columns:
+            source = filter_cohort_person(df=source, cohort_person=cohort_person)
+        if is_koalas(source) and len(groups) > 1:
+            source = source.spark.cache()
 
-    # Outcome 9: nasopharyngitis condition during hospitalization
-    # Filter event
-    nasopharyngitis_condition = filter_event(
-        df=condition_occurrence,
-        col_to_filter="condition_source_value",
-        event_regex=nasopharyngitis_regex,
-    )
-    # Keep one condition per visit
-    nasopharyngitis_condition = filter_first_event(
-        df=nasopharyngitis_condition, col_date="condition_start_datetime"
-    )
-    # Filter on cohort visits
-    nasopharyngitis_condition = (
-        cohort_visit[
-            [
-                "person_id",
-                "visit_cohort_id",
-                "care_site_id",
-                "cohort_stay_start",
-            ]
-        ]
-        .rename(
-            columns={
-                "visit_cohort_id": "visit_occurrence_id",
-            }
-        )
-        .drop_duplicates()
-        .merge(
-            nasopharyngitis_condition[
-                [
-                    "visit_occurrence_id",
-                    "visit_detail_id",
-                    "diag_type",
-                    "condition_source_value",
-                    "condition_start_datetime",
-                ]
-            ],
-            on="visit_occurrence_id",
-        )
-    )
-    # Add detail_care_site_id
-    if condition_source_system == "ORBIS":
-        nasopharyngitis_condition = nasopharyngitis_condition.merge(
-            condition_detail,
-            on="visit_detail_id",
-            how="left",
-        )
-    # Store result
-    outcomes["nasopharyngitis_condition"] = nasopharyngitis_condition
+        for steps, outcome_names in groups.items():
+            steps = dict(zip(OUTCOME_STEPS, steps))
+            # Filter events of every outcome of the group in a single scan
+            outcome = tag_events(
+                df=source,
+                events_regex={
+                    outcome_name: outcomes[outcome_name]["event_regex"]
+                    for outcome_name in outcome_names
+                },
+                col_tag=col_tag,
+            )
+            # Keep one event per visit
+            if steps["first_event"]:
+                outcome = filter_first_event(
+                    df=outcome,
+                    col_date=steps["first_event"],
+                    index=[col_tag, "visit_occurrence_id"],
+                )
+                # Clean date
+                if steps["clean_date"]:
+                    outcome = clean_date(df=outcome, col_date=steps["first_event"])
+            if steps["columns"]:
+                outcome = outcome[[col_tag, *steps["columns"]]]
+            # Filter on cohort visits (cohort patients are filtered on source)
+            if steps["cohort_join"] == "visit_occurrence_id":
+                outcome = cohort_stay.merge(
+                    outcome[
+                        [
+                            col
+                            for col in outcome.columns
+                            if col not in cohort_stay.columns
+                            or col == "visit_occurrence_id"
+                        ]
+                    ],
+                    on="visit_occurrence_id",
+                )
+            elif (
+                steps["cohort_join"] != "person_id" or "person_id" not in source.columns
+            ):
+                raise ValueError(
+                    "cohort_join must be 'person_id' or 'visit_occurrence_id' not {}".format(
+                        steps["cohort_join"]
+                    )
+                )
+            for enrichment in steps["enrichments"] or []:
+                outcome = outcome_enrichments.get(enrichment)(
+                    outcome=outcome, tables=tables
+                )
+            if is_koalas(outcome) and len(outcome_names) > 1:
+                outcome = outcome.spark.cache()
+            # Store result
+            for outcome_name in outcome_names:
+                selected_outcomes[outcome_name] = outcome[
+                    outcome[col_tag] == outcome_name
+                ].drop(columns=col_tag)
 
-    return outcomes
+    return {outcome_name: selected_outcomes[outcome_name] for outcome_name in outcomes}
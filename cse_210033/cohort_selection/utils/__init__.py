@@ -0,0 +1,24 @@
+import catalogue
+
+from cse_210033.cohort_selection.utils.outcomes import (
+    add_condition_detail,
+    add_note_care_site,
+    add_visit_care_site,
+    condition_occurrence_source,
+    note_source,
+    visit_detail_source,
+    visit_occurrence_source,
+)
+
+outcome_sources = catalogue.create("cse_210033", "outcome_sources")
+
+outcome_sources.register("visit_occurrence", func=visit_occurrence_source)
+outcome_sources.register("note", func=note_source)
+outcome_sources.register("condition_occurrence", func=condition_occurrence_source)
+outcome_sources.register("visit_detail", func=visit_detail_source)
+
+outcome_enrichments = catalogue.create("cse_210033", "outcome_enrichments")
+
+outcome_enrichments.register("note_care_site", func=add_note_care_site)
+outcome_enrichments.register("visit_care_site", func=add_visit_care_site)
+outcome_enrichments.register("condition_detail", func=add_condition_detail)
@@ -1,48 +1,51 @@
 from datetime import date
+from typing import Tuple, Union
 
+import polars as pl
 from edsteva.utils.typing import DataFrame, Series
 
 
-def add_patient_info(visit: DataFrame, person: DataFrame):
-    # Compute ages
-    person["age_today"] = _compute_age_today(
-        person.birth_datetime, person.death_datetime
+def add_patient_info(
+    visit: DataFrame,
+    person: DataFrame,
+    col_date: str = "cohort_stay_start",
+    col_age: str = "age_at_stay",
+):
+    # Compute ages (person is left untouched so it can be cached and reused)
+    person = person.assign(
+        age_today=_compute_age_today(person.birth_datetime, person.death_datetime)
     )
     visit = visit.merge(person, on="person_id", how="inner")
-    visit["age_at_stay"] = _compute_age_at_stay(
-        birth_dates=visit.birth_datetime, cohort_stay_start=visit.cohort_stay_start
+    visit[col_age] = compute_age(
+        birth_dates=visit.birth_datetime, reference_dates=visit[col_date]
     )
     return visit
 
 
-def _compute_age_at_stay(birth_dates: Series, cohort_stay_start: Series):
-    ages = (
-        cohort_stay_start.dt.year
-        - birth_dates.dt.year
-        - (
-            (
-                cohort_stay_start.dt.strftime("%m-%d")
-                < birth_dates.dt.strftime("%m-%d")
-            ).astype(int)
-        )
-    )
-    return ages
+def compute_age(
+    birth_dates: Union[Series, pl.Series, pl.Expr],
+    reference_dates: Union[Series, pl.Series, pl.Expr, date],
+):
+    # Integer arithmetic: a birthday is passed if month * 100 + day is reached
+    birth_year, birth_month_day = _year_month_day(birth_dates)
+    reference_year, reference_month_day = _year_month_day(reference_dates)
+    before_birthday = reference_month_day < birth_month_day
+    if isinstance(before_birthday, (pl.Series, pl.Expr)):
+        before_birthday = before_birthday.cast(pl.Int32)
+    else:
+        before_birthday = before_birthday.astype(int)
+    return reference_year - birth_year - before_birthday
+
+
+def _year_month_day(dates: Union[Series, pl.Series, pl.Expr, date]) -> Tuple:
+    if isinstance(dates, date):
+        return dates.year, dates.month * 100 + dates.day
+    if isinstance(dates, (pl.Series, pl.Expr)):
+        return dates.dt.year(), dates.dt.month() * 100 + dates.dt.day()
+    return dates.dt.year, dates.dt.month * 100 + dates.dt.day
 
 
 def _compute_age_today(birth_dates: Series, death_dates: Series):
-    death_ages = (
-        death_dates.dt.year
-        - birth_dates.dt.year
-        - (
-            (
-                death_dates.dt.strftime("%m-%d") < birth_dates.dt.strftime("%m-%d")
-            ).astype(int)
-        )
-    )
-    now = date.today()
-    alive_ages = (
-        now.year
-        - birth_dates.dt.year
-        - ((now.strftime("%m-%d") < birth_dates.dt.strftime("%m-%d")).astype(int))
-    )
+    death_ages = compute_age(birth_dates=birth_dates, reference_dates=death_dates)
+    alive_ages = compute_age(birth_dates=birth_dates, reference_dates=date.today())
     return death_ages.mask(death_ages.isna(), alive_ages)
@@ -0,0 +1,63 @@
+from typing import Dict, Tuple
+
+import databricks.koalas as ks
+from pyspark.sql import SparkSession
+from pyspark.sql import functions as F
+
+
+def export_partitions(
+    df: ks.DataFrame,
+    path: str,
+    col_date: str,
+    refresh_month: str = None,
+    col_partition: str = "month",
+) -> Tuple[Tuple[int, int], str]:
+    # Executors write one Parquet folder per month of col_date, nothing is collected
+    sdf = df.to_spark()
+    spark = sdf.sql_ctx.sparkSession
+    sdf = sdf.withColumn(
+        col_partition,
+        F.coalesce(F.date_format(col_date, "yyyy-MM-01"), F.lit("undated")),
+    )
+    if refresh_month is None:
+        mode = "overwrite"
+    else:
+        # "undated" sorts after every month, so it is replaced as well
+        for month, partition_path in _list_partitions(
+            spark, path, col_partition
+        ).items():
+            if month >= refresh_month:
+                _delete_path(spark, partition_path)
+        sdf = sdf.where(F.col(col_partition) >= refresh_month)
+        mode = "append"
+    sdf.write.mode(mode).partitionBy(col_partition).parquet(path)
+
+    # Counts are computed by the cluster on the saved partitions
+    n_rows = spark.read.parquet(path).count()
+    dated_months = sorted(
+        month
+        for month in _list_partitions(spark, path, col_partition)
+        if month != "undated"
+    )
+    return (
+        (n_rows, len(sdf.columns) - 1),
+        dated_months[-1] if dated_months else None,
+    )
+
+
+def _list_partitions(spark: SparkSession, path: str, col_partition: str) -> Dict:
+    jvm_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    file_system = jvm_path.getFileSystem(spark._jsc.hadoopConfiguration())
+    if not file_system.exists(jvm_path):
+        return {}
+    partitions = {}
+    for status in file_system.listStatus(jvm_path):
+        name = status.getPath().getName()
+        if status.isDirectory() and name.startswith("{}=".format(col_partition)):
+            partitions[name.split("=", 1)[1]] = status.getPath()
+    return partitions
+
+
+def _delete_path(spark: SparkSession, jvm_path):
+    file_system = jvm_path.getFileSystem(spark._jsc.hadoopConfiguration())
+    file_system.delete(jvm_path, True)
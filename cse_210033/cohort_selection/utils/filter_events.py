@@ -1,8 +1,14 @@
-from typing import List
+from functools import reduce
+from operator import and_, or_
+from typing import Dict, List, Union
 
 import pandas as pd
+import polars as pl
+from edsteva.utils.framework import is_koalas
 from edsteva.utils.typing import DataFrame
 from loguru import logger
+from pyspark.sql import Window
+from pyspark.sql import functions as F
 
 
 def filter_event(
@@ -64,12 +70,67 @@ def filter_date(
     return cohort_visit
 
 
-def filter_first_event(df: DataFrame, col_date: str):
-    # Keep first event of each visit
-    df = (
-        df.sort_values(col_date, ascending=True)
-        .groupby("visit_occurrence_id", as_index=False)
-        .first()
+def filter_first_event(
+    df: DataFrame,
+    col_date: str,
+    index: Union[str, List[str]] = "visit_occurrence_id",
+    n_events: int = 1,
+):
+    # Keep first events of each visit with a ranking per group (no global sort)
+    index = [index] if isinstance(index, str) else list(index)
+    if isinstance(df, pl.DataFrame):
+        df = df.filter(
+            pl.col(col_date).arg_sort(nulls_last=True).arg_sort().over(index) < n_events
+        )
+    elif is_koalas(df):
+        window = Window.partitionBy(*index).orderBy(F.col(col_date).asc_nulls_last())
+        df = df.spark.apply(
+            lambda sdf: sdf.withColumn("event_rank", F.row_number().over(window))
+            .filter(F.col("event_rank") <= n_events)
+            .drop("event_rank")
+        )
+    else:
+        event_rank = df.groupby(index)[col_date].rank(
+            method="first", na_option="bottom"
+        )
+        df = df[event_rank <= n_events]
+    return df
+
+
+def tag_events(
+    df: DataFrame,
+    events_regex: Dict[str, Dict[str, str]],
+    col_tag: str,
+):
+    # Flag rows matching every regex of each event
+    df = df.assign(
+        **{
+            event_name: reduce(
+                and_,
+                [
+                    df[col_to_filter].str.contains(
+                        regex, case=False, na=False, regex=True
+                    )
+                    for col_to_filter, regex in event_regex.items()
+                ],
+            )
+            for event_name, event_regex in events_regex.items()
+        }
+    )
+
+    # Keep rows matching at least one event, one row per matching event
+    df = df[reduce(or_, [df[event_name] for event_name in events_regex])]
+    df = df.melt(
+        id_vars=[col for col in df.columns if col not in events_regex],
+        value_vars=list(events_regex),
+        var_name=col_tag,
+        value_name="has_tag",
+    )
+    df = df[df.has_tag].drop(columns="has_tag")
+    logger.debug(
+        "Tag events: rows have been tagged with {} in column {}.",
+        list(events_regex),
+        col_tag,
     )
     return df
 
@@ -97,3 +158,24 @@ def filter_diag(condition_occurrence: DataFrame, diag_regex: List[str]):
         "Filter diag: the following stay types {} have been selected.", diag_regex
     )
     return condition_occurrence
+
+
+def get_cohort_person(cohort_visit: DataFrame, broadcast_threshold: int):
+    # Distinct cohort patients, computed once and shared by every outcome
+    cohort_person = cohort_visit[["person_id"]].drop_duplicates()
+    if is_koalas(cohort_person):
+        cohort_person = cohort_person.spark.cache()
+        n_person = len(cohort_person)
+        if n_person <= broadcast_threshold:
+            cohort_person = cohort_person.spark.hint("broadcast")
+        logger.debug(
+            "Cohort person: {} patients, broadcast {}.",
+            n_person,
+            n_person <= broadcast_threshold,
+        )
+    return cohort_person
+
+
+def filter_cohort_person(df: DataFrame, cohort_person: DataFrame):
+    # Semi-join: cohort_person holds distinct keys only
+    return df.merge(cohort_person, on="person_id", how="inner")
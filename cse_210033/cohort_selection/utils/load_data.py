@@ -0,0 +1,38 @@
+from typing import Dict, List
+
+import databricks.koalas as ks
+from loguru import logger
+from pyspark.sql import SparkSession
+
+
+class PrunedHiveData:
+    def __init__(
+        self,
+        database_name: str,
+        spark_session: SparkSession,
+        tables_to_load: Dict[str, Dict[str, List[str]]],
+    ):
+        self.database_name = database_name
+        self.spark_session = spark_session
+        self.available_tables = list(tables_to_load.keys())
+        for table_name, table_scan in tables_to_load.items():
+            setattr(self, table_name, self._read_table(table_name, **table_scan))
+
+    def _read_table(
+        self,
+        table_name: str,
+        columns: List[str],
+        filters: List[str] = None,
+    ):
+        # Filters and projection are applied on the scan, before any index
+        table = self.spark_session.table("{}.{}".format(self.database_name, table_name))
+        for table_filter in filters or []:
+            table = table.where(table_filter)
+        table = table.select(*columns)
+        logger.debug(
+            "Load table {}: columns {} with filters {}.",
+            table_name,
+            columns,
+            filters,
+        )
+        return ks.DataFrame(table)
@@ -0,0 +1,99 @@
+from typing import Any, Dict, List, Tuple
+
+from edsteva.utils.typing import DataFrame
+
+OUTCOME_STEPS = ["first_event", "clean_date", "columns", "cohort_join", "enrichments"]
+
+
+def plan_outcomes(
+    outcomes: Dict[str, Dict[str, Any]]
+) -> Dict[str, Dict[Tuple, List[str]]]:
+    # Group outcomes per source table, then per identical processing steps
+    plan = {}
+    for outcome_name, outcome_conf in outcomes.items():
+        steps = tuple(
+            tuple(step) if isinstance(step, list) else step
+            for step in (outcome_conf.get(step) for step in OUTCOME_STEPS)
+        )
+        plan.setdefault(outcome_conf["source"], {}).setdefault(steps, []).append(
+            outcome_name
+        )
+    return plan
+
+
+# Sources
+def visit_occurrence_source(tables: Dict[str, DataFrame]):
+    return tables["visit_occurrence"]
+
+
+def note_source(tables: Dict[str, DataFrame]):
+    return tables["note"]
+
+
+def condition_occurrence_source(tables: Dict[str, DataFrame]):
+    return tables["condition_occurrence"]
+
+
+def visit_detail_source(tables: Dict[str, DataFrame]):
+    detail_care_site = tables["care_site"][["care_site_id", "service_type"]].rename(
+        columns={
+            "care_site_id": "detail_care_site_id",
+        }
+    )
+    visit_detail = (
+        tables["visit_occurrence"][
+            [
+                "visit_occurrence_id",
+                "person_id",
+                "care_site_id",
+                "visit_start_datetime",
+                "stay_type",
+            ]
+        ]
+        .merge(
+            tables["visit_detail"],
+            on="visit_occurrence_id",
+            how="inner",
+        )
+        .merge(
+            detail_care_site,
+            on="detail_care_site_id",
+            how="inner",
+        )
+    )
+    return visit_detail
+
+
+# Enrichments
+def add_note_care_site(outcome: DataFrame, tables: Dict[str, DataFrame]):
+    # Add detail_care_site_id
+    return outcome.merge(
+        tables["note_care_site"],
+        on="note_id",
+    ).drop(columns="note_id")
+
+
+def add_visit_care_site(outcome: DataFrame, tables: Dict[str, DataFrame]):
+    # Add care_site_id
+    return outcome.merge(
+        tables["visit_occurrence"][
+            [
+                "visit_occurrence_id",
+                "care_site_id",
+                "visit_start_datetime",
+            ]
+        ],
+        on="visit_occurrence_id",
+        how="left",
+    )
+
+
+def add_condition_detail(outcome: DataFrame, tables: Dict[str, DataFrame]):
+    # Add detail_care_site_id (only available for ORBIS conditions)
+    if tables["condition_detail"] is None:
+        return outcome
+    return outcome.merge(
+        tables["condition_detail"],
+        on="visit_detail_id",
+        how="left",
+    )
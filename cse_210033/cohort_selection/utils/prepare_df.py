@@ -8,6 +8,114 @@ from edsteva.utils.typing import Data, DataFrame
 from .filter_events import clean_date, filter_diag, filter_source
 
 
+def get_tables_to_load(
+    start_date: str,
+    note_source_system: str,
+    person_source_system: str,
+    visit_source_system: str,
+    condition_source_system: str,
+    **kwargs,
+):
+    # Columns and row filters needed by each prepare function
+    tables_to_load = dict(
+        care_site=dict(
+            columns=[
+                "care_site_id",
+                "care_site_type_source_value",
+                "care_site_short_name",
+                "place_of_service_source_value",
+            ],
+        ),
+        visit_occurrence=dict(
+            columns=[
+                "visit_occurrence_id",
+                "visit_occurrence_source_value",
+                "person_id",
+                "care_site_id",
+                "visit_start_datetime",
+                "visit_end_datetime",
+                "visit_source_value",
+                "stay_source_value",
+                "cdm_source",
+                "row_status_source_value",
+            ],
+            filters=[
+                "cdm_source = '{}'".format(visit_source_system),
+                # Visits ended before the study period cannot follow a cohort stay
+                "visit_end_datetime IS NULL OR visit_end_datetime >= '{}'".format(
+                    start_date
+                ),
+            ],
+        ),
+        visit_detail=dict(
+            columns=[
+                "visit_detail_id",
+                "visit_detail_start_datetime",
+                "visit_occurrence_id",
+                "visit_detail_type_source_value",
+                "care_site_id",
+                "row_status_source_value",
+            ],
+            filters=["row_status_source_value = 'Actif'"],
+        ),
+        note=dict(
+            columns=[
+                "note_id",
+                "person_id",
+                "visit_occurrence_id",
+                "note_datetime",
+                "note_class_source_value",
+                "row_status_source_value",
+                "cdm_source",
+            ],
+            filters=[
+                "cdm_source = '{}'".format(note_source_system),
+                "row_status_source_value = 'Actif'",
+                # Note text is only checked for null, never loaded
+                "note_text IS NOT NULL",
+            ],
+        ),
+        person=dict(
+            columns=[
+                "person_id",
+                "birth_datetime",
+                "death_datetime",
+                "gender_source_value",
+                "status_source_value",
+                "cdm_source",
+            ],
+            filters=[
+                "cdm_source = '{}'".format(person_source_system),
+                "status_source_value = 'Actif'",
+            ],
+        ),
+    )
+    if condition_source_system == "ORBIS":
+        tables_to_load["condition_occurrence"] = dict(
+            columns=[
+                "visit_occurrence_id",
+                "visit_detail_id",
+                "cdm_source",
+                "condition_status_source_value",
+                "condition_source_value",
+                "condition_start_datetime",
+            ],
+            filters=["cdm_source = '{}'".format(condition_source_system)],
+        )
+    return tables_to_load
+
+
+def get_ghm_tables_to_load(ghm_source_system: str, **kwargs):
+    # Columns and row filters needed by prepare_ghm
+    return dict(
+        orbis_visite_calc=dict(columns=["ids_eds", "ids_eds_crypt"]),
+        i2b2_observation_fact_ghm=dict(
+            columns=["encounter_num", "concept_cd", "sourcesystem_cd"],
+            filters=["sourcesystem_cd = '{}'".format(ghm_source_system)],
+        ),
+    )
+
+
 def prepare_care_site(
     data: Data,
 ):
@@ -175,7 +283,11 @@ def prepare_visit_occurrence(
 
 
 def prepare_note(data: Data, note_source_system: str):
-    note = data.note[
+    note = data.note
+    # Keep notes with text (already filtered on scan if note_text is not loaded)
+    if "note_text" in note.columns:
+        note = note[~(note.note_text.isna())]
+    note = note[
         [
             "note_id",
             "person_id",
@@ -183,7 +295,6 @@ def prepare_note(data: Data, note_source_system: str):
             "note_datetime",
             "note_class_source_value",
             "row_status_source_value",
-            "note_text",
             "cdm_source",
         ]
     ].rename(columns={"note_class_source_value": "note_type"})
@@ -191,7 +302,6 @@ def prepare_note(data: Data, note_source_system: str):
     note = filter_valid_observations(
         table=note, table_name="note", valid_naming="Actif"
     )
-    note = note[~(note.note_text.isna())]
 
     # Keep source observations
     note = filter_source(
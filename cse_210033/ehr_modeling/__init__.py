@@ -0,0 +1,6 @@
+from cse_210033.ehr_modeling.ehr_modeling import (
+    compute_probes,
+    fit_models,
+    get_count_column,
+    load_previous_models,
+)
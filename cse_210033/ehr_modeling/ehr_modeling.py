@@ -0,0 +1,169 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Tuple
+
+import pandas as pd
+from loguru import logger
+
+from .utils import ehr_models, probe_sources
+from .utils.models import (
+    compare_partitions,
+    filter_model,
+    filter_probe,
+    fit_shard,
+    get_partition_hashes,
+    merge_shards,
+    split_probe,
+)
+from .utils.probes import SHARED_TABLES, cache_tables, plan_probes, uncache_tables
+from .utils.store import load_model, load_partition_hashes
+
+
+def compute_probes(
+    data: Any,
+    extra_data: Dict[str, Any],
+    probes: Dict[str, Dict[str, Any]],
+    parameters: Dict[str, Dict[str, Any]],
+    refresh_months: Dict[str, str] = None,
+):
+    # Probes of a same source share one scan of its tables: the shared tables are
+    # cached for the whole stage, the source tables while its probes are computed.
+    # A probe with a refresh month is only computed from that month on
+    shared_tables = cache_tables(data, SHARED_TABLES)
+    try:
+        for source_name, probe_names in plan_probes(probes).items():
+            source = probe_sources.get(source_name)()
+            source_extra_data = extra_data.get(source_name)
+            source_tables = cache_tables(
+                data, source["tables"], projections=source.get("projections")
+            )
+            if source_extra_data is not None:
+                source_tables += cache_tables(source_extra_data, source["extra_tables"])
+            try:
+                for probe_name in probe_names:
+                    probe_conf = probes[probe_name]
+                    probe_parameters = dict(parameters[probe_conf["parameters"]])
+                    if refresh_months and refresh_months.get(probe_name):
+                        probe_parameters["start_date"] = max(
+                            probe_parameters["start_date"], refresh_months[probe_name]
+                        )
+                    logger.info("Computing {} probe...", probe_name)
+                    probe = source["probe"](
+                        completeness_predictor=probe_conf["completeness_predictor"]
+                    )
+                    if source_extra_data is not None:
+                        probe.compute(
+                            data=data,
+                            extra_data=source_extra_data,
+                            **probe_parameters,
+                        )
+                    else:
+                        probe.compute(data=data, **probe_parameters)
+                    logger.info(
+                        "{} probe has shape {}", probe_name, probe.predictor.shape
+                    )
+                    yield probe_name, probe
+            finally:
+                uncache_tables(source_tables)
+    finally:
+        uncache_tables(shared_tables)
+
+
+def get_count_column(probe_conf: Dict[str, Any]) -> str:
+    # Count normalizing the completeness predictor of the probe, if normalized
+    source = probe_sources.get(probe_conf["source"])()
+    return source["count_columns"].get(probe_conf["completeness_predictor"])
+
+
+def fit_models(
+    probes: Dict[str, Any],
+    models: Dict[str, Dict[str, Any]],
+    n_jobs: int = 1,
+    previous_models: Dict[str, Tuple[Any, pd.DataFrame]] = None,
+):
+    # Partitions are fitted independently: the care sites of every probe are
+    # spread over a process pool and each model is merged back from its shards.
+    # With previous models, only the partitions whose predictor changed are refitted.
+    # Models of empty probes are skipped
+    model_classes = {
+        model_name: ehr_models.get(models[model_name]["model"])()
+        for model_name in probes.keys()
+    }
+    fits = {}
+    for model_name, probe in probes.items():
+        partition_hashes = get_partition_hashes(probe)
+        fit_probe, reused_models = probe, []
+        if previous_models and model_name in previous_models:
+            previous_model, previous_partition_hashes = previous_models[model_name]
+            changed, unchanged = compare_partitions(
+                partition_hashes, previous_partition_hashes
+            )
+            logger.info(
+                "{} model: {} partitions changed, {} unchanged",
+                model_name,
+                changed.shape[0],
+                unchanged.shape[0],
+            )
+            fit_probe = filter_probe(probe, changed)
+            reused_models = [filter_model(previous_model, unchanged)]
+        fits[model_name] = (partition_hashes, fit_probe, reused_models)
+
+    if n_jobs <= 1:
+        for model_name, (partition_hashes, fit_probe, reused_models) in fits.items():
+            fitted_models = []
+            if not fit_probe.predictor.empty:
+                fitted_models.append(fit_shard(model_classes[model_name], fit_probe))
+            if not fitted_models + reused_models:
+                logger.warning("{} model is skipped: its probe is empty", model_name)
+                continue
+            if reused_models:
+                model = merge_shards(
+                    fitted_models + reused_models,
+                    index=list(probes[model_name]._index),
+                )
+            else:
+                model = fitted_models[0]
+            logger.info("{} model has shape {}", model_name, model.estimates.shape)
+            yield model_name, model, partition_hashes
+        return
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        # Every shard is submitted first so that the pool stays busy across probes
+        shard_fits = {
+            model_name: [
+                executor.submit(fit_shard, model_classes[model_name], shard_probe)
+                for shard_probe in split_probe(fit_probe, n_jobs)
+            ]
+            for model_name, (_, fit_probe, _) in fits.items()
+        }
+        for model_name, (partition_hashes, _, reused_models) in fits.items():
+            shard_models = [shard_fit.result() for shard_fit in shard_fits[model_name]]
+            if not shard_models + reused_models:
+                logger.warning("{} model is skipped: its probe is empty", model_name)
+                continue
+            model = merge_shards(
+                shard_models + reused_models,
+                index=list(probes[model_name]._index),
+            )
+            logger.info("{} model has shape {}", model_name, model.estimates.shape)
+            yield model_name, model, partition_hashes
+
+
+def load_previous_models(models: Dict[str, Dict[str, Any]], models_folder_path: Path):
+    # Previous models and the partition hashes of the predictors they were fitted on
+    previous_models = {}
+    for model_name, model_conf in models.items():
+        model_path = models_folder_path / "{}.arrow".format(model_name)
+        hashes_path = models_folder_path / "{}_hashes.parquet".format(model_name)
+        if not (model_path.exists() and hashes_path.exists()):
+            continue
+        model = load_model(
+            ehr_models.get(model_conf["model"])(),
+            models_folder_path=models_folder_path,
+            model_name=model_name,
+        )
+        previous_models[model_name] = (
+            model,
+            load_partition_hashes(models_folder_path, model_name),
+        )
+    return previous_models
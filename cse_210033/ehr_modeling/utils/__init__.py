@@ -0,0 +1,22 @@
+import catalogue
+
+from cse_210033.ehr_modeling.utils.models import (
+    rectangle_function_model,
+    step_function_model,
+)
+from cse_210033.ehr_modeling.utils.probes import (
+    condition_source,
+    note_source,
+    visit_source,
+)
+
+probe_sources = catalogue.create("cse_210033", "probe_sources")
+
+probe_sources.register("visit", func=visit_source)
+probe_sources.register("condition", func=condition_source)
+probe_sources.register("note", func=note_source)
+
+ehr_models = catalogue.create("cse_210033", "ehr_models")
+
+ehr_models.register("StepFunction", func=step_function_model)
+ehr_models.register("RectangleFunction", func=rectangle_function_model)
@@ -0,0 +1,111 @@
+import copy
+import hashlib
+from typing import Any, List, Tuple
+
+import pandas as pd
+from edsteva.models.rectangle_function import RectangleFunction
+from edsteva.models.step_function import StepFunction
+
+
+def split_probe(probe: Any, n_shards: int) -> List[Any]:
+    # Partitions of a care site stay in the same shard, shards are fitted apart
+    care_site_number = probe.predictor.groupby("care_site_id", sort=False).ngroup()
+    shards = []
+    for shard in range(n_shards):
+        shard_probe = copy.copy(probe)
+        shard_probe.predictor = probe.predictor[care_site_number % n_shards == shard]
+        if not shard_probe.predictor.empty:
+            shards.append(shard_probe)
+    return shards
+
+
+def fit_shard(model_class: type, probe: Any):
+    model = model_class()
+    model.fit(probe=probe)
+    return model
+
+
+def merge_shards(models: List[Any], index: List[str]):
+    # Partition tables (estimates and their cache) are put back in the serial order,
+    # the other attributes are the same for every shard. Models loaded from the store
+    # only have the estimates and their cache
+    model = copy.copy(models[0])
+    for attribute, value in vars(models[0]).items():
+        if isinstance(value, pd.DataFrame):
+            merged = pd.concat([getattr(shard, attribute, None) for shard in models])
+            sort_columns = [column for column in index if column in merged.columns]
+            if sort_columns:
+                merged = merged.sort_values(sort_columns, kind="mergesort")
+            setattr(model, attribute, merged.reset_index(drop=True))
+    return model
+
+
+def get_partition_hashes(probe: Any) -> pd.DataFrame:
+    # One digest of the predictor series (every date and value) per partition
+    partition_columns = get_partition_columns(probe)
+    predictor = probe.predictor.sort_values(partition_columns + ["date"])
+    row_hashes = pd.util.hash_pandas_object(
+        predictor.drop(columns=partition_columns), index=False
+    )
+    return (
+        predictor[partition_columns]
+        .assign(predictor_hash=row_hashes.values)
+        .groupby(partition_columns, dropna=False, as_index=False, sort=False)
+        .predictor_hash.agg(
+            lambda hashes: hashlib.sha1(hashes.values.tobytes()).hexdigest()
+        )
+    )
+
+
+def get_partition_columns(probe: Any) -> List[str]:
+    return [
+        column
+        for column in probe._index
+        if column != "date" and column in probe.predictor.columns
+    ]
+
+
+def compare_partitions(
+    partition_hashes: pd.DataFrame, previous_partition_hashes: pd.DataFrame
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    # Changed partitions are new partitions or partitions whose series moved
+    partitions = partition_hashes.merge(
+        previous_partition_hashes,
+        on=list(partition_hashes.columns),
+        how="left",
+        indicator=True,
+    )
+    partition_columns = [
+        column for column in partition_hashes.columns if column != "predictor_hash"
+    ]
+    changed = partitions[partitions._merge == "left_only"][partition_columns]
+    unchanged = partitions[partitions._merge == "both"][partition_columns]
+    return changed, unchanged
+
+
+def filter_partitions(data: pd.DataFrame, partitions: pd.DataFrame):
+    return data.merge(partitions, on=list(partitions.columns), how="inner")
+
+
+def filter_probe(probe: Any, partitions: pd.DataFrame):
+    filtered_probe = copy.copy(probe)
+    filtered_probe.predictor = filter_partitions(probe.predictor, partitions)
+    return filtered_probe
+
+
+def filter_model(model: Any, partitions: pd.DataFrame):
+    # Partition tables (estimates and their cache) only keep the given partitions
+    filtered_model = copy.copy(model)
+    for attribute, value in vars(model).items():
+        if isinstance(value, pd.DataFrame):
+            setattr(filtered_model, attribute, filter_partitions(value, partitions))
+    return filtered_model
+
+
+# Models
+def step_function_model():
+    return StepFunction
+
+
+def rectangle_function_model():
+    return RectangleFunction
@@ -0,0 +1,77 @@
+from typing import Any, Callable, Dict, List, Tuple
+
+from edsteva.probes import ConditionProbe, NoteProbe, VisitProbe
+from loguru import logger
+
+# Tables read by every probe (care site hierarchy and visits)
+SHARED_TABLES = ["care_site", "fact_relationship", "visit_occurrence", "visit_detail"]
+
+
+def plan_probes(probes: Dict[str, Dict[str, Any]]) -> Dict[str, List[str]]:
+    # Group probes per source, in config order
+    plan = {}
+    for probe_name, probe_conf in probes.items():
+        plan.setdefault(probe_conf["source"], []).append(probe_name)
+    return plan
+
+
+def cache_tables(
+    data: Any, table_names: List[str], projections: Dict[str, Callable] = None
+) -> List[Tuple]:
+    # Tables are cached in place so that probes read the shared scan, a table with a
+    # projection is cached without the columns the probes do not read
+    projections = projections or {}
+    cached_tables = []
+    for table_name in table_names:
+        if not hasattr(data, table_name):
+            continue
+        table = getattr(data, table_name)
+        projection = projections.get(table_name)
+        cached_table = (projection(table) if projection else table).spark.cache()
+        setattr(data, table_name, cached_table)
+        cached_tables.append((data, table_name, table, cached_table))
+        logger.debug("Cache table {}.", table_name)
+    return cached_tables
+
+
+def uncache_tables(cached_tables: List[Tuple]):
+    for data, table_name, table, cached_table in cached_tables:
+        cached_table.spark.unpersist()
+        setattr(data, table_name, table)
+        logger.debug("Uncache table {}.", table_name)
+
+
+def project_note(note: Any) -> Any:
+    # Note text is only checked for null, it is dropped before caching
+    note = note[note.note_text.notnull()]
+    return note.drop(columns="note_text")
+
+
+# Sources (projections: applied to a table before caching, count_columns: count
+# normalizing each normalized completeness predictor)
+def visit_source():
+    return dict(
+        probe=VisitProbe,
+        tables=[],
+        extra_tables=[],
+        count_columns={"per_visit_default": "n_visit"},
+    )
+
+
+def condition_source():
+    return dict(
+        probe=ConditionProbe,
+        tables=["condition_occurrence"],
+        extra_tables=["condition_occurrence", "visit_occurrence"],
+        count_columns={"per_condition_default": "n_condition"},
+    )
+
+
+def note_source():
+    return dict(
+        probe=NoteProbe,
+        tables=["note"],
+        extra_tables=["note_ref", "care_site_ref"],
+        projections={"note": project_note},
+        count_columns={"per_note_default": "n_note"},
+    )
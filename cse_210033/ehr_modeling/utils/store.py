@@ -0,0 +1,169 @@
+import datetime
+import json
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+import pandas as pd
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from cse_210033.utils import dump_data, scan_partitions
+
+
+def save_model(model: Any, models_folder_path: Path, model_name: str):
+    # Uncompressed Arrow IPC so that the estimates can be memory-mapped. Written with
+    # pyarrow: models are fitted next to Spark 2.4, with pyarrow 0.16
+    estimates = pa.Table.from_pandas(model.estimates, preserve_index=False)
+    with pa.OSFile(str(models_folder_path / "{}.arrow".format(model_name)), "wb") as f:
+        writer = pa.RecordBatchFileWriter(f, estimates.schema)
+        writer.write_table(estimates)
+        writer.close()
+    save_metadata(model, models_folder_path / "{}.json".format(model_name))
+
+
+def save_partition_hashes(
+    partition_hashes: pd.DataFrame, models_folder_path: Path, model_name: str
+):
+    pq.write_table(
+        pa.Table.from_pandas(partition_hashes, preserve_index=False),
+        str(models_folder_path / "{}_hashes.parquet".format(model_name)),
+    )
+
+
+def load_partition_hashes(models_folder_path: Path, model_name: str) -> pd.DataFrame:
+    return pq.read_table(
+        str(models_folder_path / "{}_hashes.parquet".format(model_name))
+    ).to_pandas()
+
+
+def save_probe(probe: Any, probes_folder_path: Path, probe_name: str):
+    # The predictor itself is stored in monthly partitions (see save_partitions)
+    save_metadata(probe, probes_folder_path / "{}.json".format(probe_name))
+
+
+def save_metadata(ehr_object: Any, path: Path):
+    # Attributes other than tables: tables are stored apart (estimates, predictor) or
+    # rebuilt on loading (their cache), any attribute of an unknown type raises
+    attributes = {
+        attribute: encode_attribute(value, name=attribute)
+        for attribute, value in vars(ehr_object).items()
+        if not isinstance(value, pd.DataFrame)
+    }
+    dump_data(attributes, path)
+
+
+def load_metadata(path: Path):
+    with open(path, "r") as f:
+        return json.load(f, object_hook=decode_attribute)
+
+
+def encode_attribute(value: Any, name: str):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (pd.Timestamp, datetime.datetime, np.datetime64)):
+        return {"__timestamp__": pd.Timestamp(value).isoformat()}
+    if isinstance(value, (pd.Timedelta, datetime.timedelta, np.timedelta64)):
+        return {"__timedelta__": pd.Timedelta(value).isoformat()}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, datetime.date):
+        return {"__date__": value.isoformat()}
+    if isinstance(value, tuple):
+        return {"__tuple__": [encode_attribute(item, name) for item in value]}
+    if isinstance(value, (list, set)):
+        return [encode_attribute(item, name) for item in value]
+    if isinstance(value, dict) and all(isinstance(key, str) for key in value):
+        return {key: encode_attribute(item, name) for key, item in value.items()}
+    raise TypeError(
+        "Attribute {} of type {} cannot be stored".format(name, type(value).__name__)
+    )
+
+
+def decode_attribute(value: Dict):
+    if "__timestamp__" in value:
+        return pd.Timestamp(value["__timestamp__"])
+    if "__timedelta__" in value:
+        return pd.Timedelta(value["__timedelta__"])
+    if "__date__" in value:
+        return datetime.date.fromisoformat(value["__date__"])
+    if "__tuple__" in value:
+        return tuple(value["__tuple__"])
+    return value
+
+
+def scan_estimates(
+    models_folder_path: Path,
+    model_name: str,
+    columns: List[str] = None,
+    filters: Dict[str, Any] = None,
+):
+    estimates = pl.scan_ipc(
+        models_folder_path / "{}.arrow".format(model_name), memory_map=True
+    )
+    return _select(estimates, columns=columns, filters=filters)
+
+
+def scan_predictor(
+    probes_folder_path: Path,
+    probe_name: str,
+    columns: List[str] = None,
+    filters: Dict[str, Any] = None,
+):
+    predictor = scan_partitions(probes_folder_path / probe_name)
+    return _select(predictor, columns=columns, filters=filters)
+
+
+def load_model(
+    model_class: type,
+    models_folder_path: Path,
+    model_name: str,
+    columns: List[str] = None,
+    filters: Dict[str, Any] = None,
+):
+    model = model_class()
+    for attribute, value in load_metadata(
+        models_folder_path / "{}.json".format(model_name)
+    ).items():
+        setattr(model, attribute, value)
+    # Read with pyarrow, previous models are also loaded next to Spark 2.4
+    with pa.memory_map(str(models_folder_path / "{}.arrow".format(model_name))) as f:
+        estimates = pa.RecordBatchFileReader(f).read_all().to_pandas()
+    for column, value in (filters or {}).items():
+        estimates = estimates[estimates[column] == value]
+    if columns is not None:
+        estimates = estimates[columns]
+    model.estimates = estimates.reset_index(drop=True)
+    model.cache_estimates()
+    return model
+
+
+def load_probe(
+    probe_class: type,
+    probes_folder_path: Path,
+    probe_name: str,
+    columns: List[str] = None,
+    filters: Dict[str, Any] = None,
+):
+    probe = probe_class()
+    for attribute, value in load_metadata(
+        probes_folder_path / "{}.json".format(probe_name)
+    ).items():
+        setattr(probe, attribute, value)
+    probe.predictor = (
+        scan_predictor(probes_folder_path, probe_name, columns, filters)
+        .collect()
+        .to_pandas()
+    )
+    probe.cache_predictor()
+    return probe
+
+
+def _select(table: pl.LazyFrame, columns: List[str] = None, filters: Dict = None):
+    # Filters and projection are pushed down to the scan
+    for column, value in (filters or {}).items():
+        table = table.filter(pl.col(column) == value)
+    if columns is not None:
+        table = table.select(columns)
+    return table
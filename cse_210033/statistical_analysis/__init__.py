@@ -1 +1,4 @@
-from cse_210033.statistical_analysis.statistical_analysis import statistical_analysis
+from cse_210033.statistical_analysis.statistical_analysis import (
+    get_event_columns,
+    statistical_analysis,
+)
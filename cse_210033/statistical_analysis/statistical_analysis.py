@@ -1,19 +1,32 @@
 import time
-from datetime import datetime
-from typing import List
+from typing import Dict, List
 
 import polars as pl
 from loguru import logger
 
-from .utils import key_functions
-from .utils.complete_source import estimate_parameters, filter_unstable_cs_from_event_df
+from .utils import grid_key_functions, key_event_columns, key_functions
+from .utils.complete_source import estimate_parameters, get_care_site_columns
+from .utils.grid import GRID_COLUMNS, get_grid, get_stability_constraints
+from .utils.lazy import Frame
+
+
+def get_event_columns(
+    key_function: str, care_site_level: str, col_date: str = None, **kwargs
+):
+    # Columns of the event table needed by the analysis of an outcome
+    event_columns = key_event_columns[key_function] + get_care_site_columns(
+        care_site_level
+    )
+    if col_date:
+        event_columns.append(col_date)
+    return event_columns
 
 
 def statistical_analysis(
-    cohort_visit_all: pl.DataFrame,
-    cs_count: pl.DataFrame,
-    event_df: pl.DataFrame,
-    ehr_estimates: pl.DataFrame,
+    cohort_visit_all: Frame,
+    cs_count: Frame,
+    event_df: Frame,
+    ehr_estimates: Frame,
     event_name: str,
     key_function: str,
     care_site_level: str,
@@ -28,8 +41,22 @@ def statistical_analysis(
     diag_type: str = None,
     specialties_set: str = None,
     condition_type: str = None,
+    error_quantiles: List[float] = [0.75, 0.5, 0.25],
+    c_0_quantiles: List[float] = [0.25, 0.5, 0.75],
+    quantiles_sample_size: int = None,
+    totals: Dict[str, str] = None,
+    streaming: bool = False,
     **kwargs
 ):
+    # The whole analysis is planned lazily and collected once. Estimates are left
+    # as given: eager estimates are fingerprinted once and shared by every outcome
+    start = time.time()
+    cohort_visit_all, cs_count, event_df = (
+        cohort_visit_all.lazy(),
+        cs_count.lazy(),
+        event_df.lazy(),
+    )
+
     # Estimates parameters
     naive_cs_count, max_errors_from_stats, min_c_0s_from_stats = estimate_parameters(
         ehr_estimates=ehr_estimates,
@@ -40,117 +67,83 @@ def statistical_analysis(
         diag_type=diag_type,
         specialties_set=specialties_set,
         condition_type=condition_type,
+        error_quantiles=error_quantiles,
+        c_0_quantiles=c_0_quantiles,
+        quantiles_sample_size=quantiles_sample_size,
     )
 
+    grid = get_grid(
+        start_observation_dates=start_observation_dates,
+        max_errors=max_errors_from_stats,
+        min_c_0s=min_c_0s_from_stats,
+    ).lazy()
+
     # Naive
-    tic = time.time()
     naive_analysis_all = key_functions.get(key_function)(
         event_df=event_df,
         cohort_visit=cohort_visit_all,
         sensibility_variables=sensibility_variables,
         col_date=col_date,
         thresholds=thresholds,
+        totals=totals,
     )
-    naive_cs_count_all = cs_count.filter(
-        pl.col("care_site_level") == care_site_level
-    ).with_columns(
-        pl.lit(naive_cs_count).alias(
-            "naive_cs_count"
-        ),  # Care site with at least one record
+    naive_analysis = (
+        naive_analysis_all.join(grid, how="cross")
+        .filter(pl.col("sub_cohort") >= pl.col("start_observation_datetime"))
+        .drop("start_observation_datetime")
+        .with_columns(
+            pl.lit("Naive analysis").alias("Statistical analysis"),
+        )
     )
-    naive_analysis_with_params = []
-    cs_count_with_params = []
-    for start_observation_date in start_observation_dates:
-        for max_error in max_errors_from_stats:
-            for min_c_0 in min_c_0s_from_stats:
-                naive_analysis_with_param = naive_analysis_all.clone()
-                naive_analysis_with_param = naive_analysis_with_param.filter(
-                    pl.col("sub_cohort")
-                    >= datetime.strptime(start_observation_date, "%Y-%m-%d")
-                ).with_columns(
-                    pl.lit(start_observation_date).alias("start_observation_date"),
-                    pl.lit(max_error).alias("max_error"),
-                    pl.lit(min_c_0).alias("min_c_0"),
-                )
-                naive_analysis_with_params.append(naive_analysis_with_param)
-                cs_count_with_params.append(
-                    naive_cs_count_all.clone().with_columns(
-                        pl.lit(start_observation_date).alias("start_observation_date"),
-                        pl.lit(max_error).alias("max_error"),
-                        pl.lit(min_c_0).alias("min_c_0"),
-                    )
-                )
-    naive_analysis = pl.concat(naive_analysis_with_params).with_columns(
-        pl.lit("Naive analysis").alias("Statistical analysis"),
+    naive_cs_count_summary = (
+        cs_count.filter(pl.col("care_site_level") == care_site_level)
+        .with_columns(
+            pl.lit(naive_cs_count).alias(
+                "naive_cs_count"
+            ),  # Care site with at least one record
+        )
+        .join(grid.select(GRID_COLUMNS), how="cross")
     )
-    naive_cs_count_summary = pl.concat(cs_count_with_params)
-    tac = time.time()
-    logger.debug("Naive analysis for {} is completed: {} s", event_name, tac - tic)
 
-    # Complete-source-only
-    tic = time.time()
-    complete_source_only_analysis = []
-    cso_cs_counts = []
-    for start_observation_date in start_observation_dates:
-        for max_error in max_errors_from_stats:
-            for min_c_0 in min_c_0s_from_stats:
-                cso_cs_count, stable_event_df = filter_unstable_cs_from_event_df(
-                    event_df=event_df,
-                    ehr_estimates=ehr_estimates,
-                    care_site_level=care_site_level,
-                    stay_type=stay_type,
-                    note_type=note_type,
-                    source_system=source_system,
-                    diag_type=diag_type,
-                    specialties_set=specialties_set,
-                    condition_type=condition_type,
-                    start_observation_date=start_observation_date,
-                    end_date=end_date,
-                    max_error=max_error,
-                    min_c_0=min_c_0,
-                )
-                cso_analysis = key_functions.get(key_function)(
-                    event_df=stable_event_df,
-                    cohort_visit=cohort_visit_all,
-                    sensibility_variables=sensibility_variables,
-                    col_date=col_date,
-                    thresholds=thresholds,
-                )
-                cso_analysis = cso_analysis.filter(
-                    pl.col("sub_cohort")
-                    >= datetime.strptime(start_observation_date, "%Y-%m-%d")
-                ).with_columns(
-                    pl.lit(start_observation_date).alias("start_observation_date"),
-                    pl.lit(max_error).alias("max_error"),
-                    pl.lit(min_c_0).alias("min_c_0"),
-                    pl.lit("Complete-source-only analysis").alias(
-                        "Statistical analysis"
-                    ),
-                )
-                complete_source_only_analysis.append(cso_analysis)
-                cso_cs_counts.append(
-                    cs_count.filter(
-                        pl.col("care_site_level") == care_site_level
-                    ).with_columns(
-                        pl.lit(cso_cs_count).alias("cso_cs_count"),
-                        pl.lit(start_observation_date).alias("start_observation_date"),
-                        pl.lit(max_error).alias("max_error"),
-                        pl.lit(min_c_0).alias("min_c_0"),
-                    )
-                )
-        logger.debug(
-            "Complete-source-only analysis for {} at start observation date : {} is completed",
-            event_name,
-            start_observation_date,
+    # Complete-source-only: each visit is tagged with the tightest stable cell
+    cso_cs_count, stable_event_df, constraints = get_stability_constraints(
+        event_df=event_df,
+        ehr_estimates=ehr_estimates,
+        grid=grid,
+        care_site_level=care_site_level,
+        stay_type=stay_type,
+        note_type=note_type,
+        source_system=source_system,
+        diag_type=diag_type,
+        specialties_set=specialties_set,
+        condition_type=condition_type,
+        end_date=end_date,
+    )
+    complete_source_only_analysis = (
+        grid.join(
+            grid_key_functions.get(key_function)(
+                event_df=stable_event_df,
+                constraints=constraints,
+                grid=grid,
+                cohort_visit=cohort_visit_all,
+                sensibility_variables=sensibility_variables,
+                col_date=col_date,
+                thresholds=thresholds,
+                totals=totals,
+            ),
+            on=GRID_COLUMNS,
+            how="inner",
         )
-
-    complete_source_only_analysis = pl.concat(complete_source_only_analysis)
-    cso_cs_count_summary = pl.concat(cso_cs_counts)
-    tac = time.time()
-    logger.debug(
-        "Complete-source-only analysis for {} is completed: {} s",
-        event_name,
-        tac - tic,
+        .filter(pl.col("sub_cohort") >= pl.col("start_observation_datetime"))
+        .drop("start_observation_datetime")
+        .with_columns(
+            pl.lit("Complete-source-only analysis").alias("Statistical analysis"),
+        )
+    )
+    cso_cs_count_summary = (
+        cs_count.filter(pl.col("care_site_level") == care_site_level)
+        .join(grid.select(GRID_COLUMNS), how="cross")
+        .join(cso_cs_count, on=GRID_COLUMNS, how="left")
     )
 
     # Concatenate result
@@ -160,11 +153,20 @@ def statistical_analysis(
             complete_source_only_analysis,
         ],
         how="diagonal",
-    ).to_pandas()
+    )
     cs_count_outcome = cso_cs_count_summary.join(
         naive_cs_count_summary,
         on=["start_observation_date", "max_error", "min_c_0", "total_care_site"],
         how="inner",
-    ).to_pandas()
+    )
+    # Shared sub-plans (e.g. the grid, cs_count) are computed once for both outputs,
+    # in streaming mode the operations supported by polars are run in batches
+    result, cs_count_outcome = pl.collect_all(
+        [result, cs_count_outcome], streaming=streaming
+    )
+    end = time.time()
+    logger.debug(
+        "Statistical analysis for {} is completed: {} s", event_name, end - start
+    )
 
-    return cs_count_outcome, result
+    return cs_count_outcome.to_pandas(), result.to_pandas()
@@ -2,8 +2,11 @@ import catalogue
 
 from cse_210033.statistical_analysis.utils.key_variables import (
     compute_condition_incidence,
+    compute_condition_incidence_over_grid,
     compute_duration_after_event,
+    compute_duration_after_event_over_grid,
     compute_event_during_cohort_stay,
+    compute_event_during_cohort_stay_over_grid,
 )
 
 key_functions = catalogue.create("cse_210033", "key_functions")
@@ -15,3 +18,23 @@ key_functions.register(
 key_functions.register(
     "compute_event_during_cohort_stay", func=compute_event_during_cohort_stay
 )
+
+# Same key functions evaluated on every cell of the parameter grid at once
+grid_key_functions = catalogue.create("cse_210033", "grid_key_functions")
+
+grid_key_functions.register(
+    "compute_condition_incidence", func=compute_condition_incidence_over_grid
+)
+grid_key_functions.register(
+    "compute_duration_after_event", func=compute_duration_after_event_over_grid
+)
+grid_key_functions.register(
+    "compute_event_during_cohort_stay", func=compute_event_during_cohort_stay_over_grid
+)
+
+# Event columns read by each key function
+key_event_columns = dict(
+    compute_condition_incidence=["visit_occurrence_id"],
+    compute_duration_after_event=["visit_occurrence_id", "person_id"],
+    compute_event_during_cohort_stay=["visit_occurrence_id"],
+)
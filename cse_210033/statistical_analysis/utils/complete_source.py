@@ -1,12 +1,36 @@
+import threading
 import time
+import weakref
+from collections import OrderedDict
 from datetime import datetime
+from typing import List
 
 import polars as pl
 from loguru import logger
 
+from .lazy import Frame, collect, is_lazy, to_eager
+
+# Columns on which estimates are filtered, estimates are partitioned on them once
+ESTIMATES_PARTITION_COLUMNS = [
+    "care_site_level",
+    "note_type",
+    "stay_type",
+    "specialties_set",
+    "diag_type",
+    "source_system",
+    "condition_type",
+]
+ESTIMATES_PARTITIONS_CACHE_SIZE = 8
+ESTIMATES_VIEWS_CACHE_SIZE = 64
+
+_estimates_fingerprints = {}
+_estimates_partitions = OrderedDict()
+_estimates_views = OrderedDict()
+_estimates_lock = threading.RLock()
+
 
 def estimate_parameters(
-    ehr_estimates: pl.DataFrame,
+    ehr_estimates: Frame,
     care_site_level: str,
     note_type: str = None,
     stay_type: str = None,
@@ -14,11 +38,14 @@ def estimate_parameters(
     diag_type: str = None,
     source_system: str = None,
     condition_type: str = None,
+    error_quantiles: List[float] = [0.75, 0.5, 0.25],
+    c_0_quantiles: List[float] = [0.25, 0.5, 0.75],
+    quantiles_sample_size: int = None,
 ):
     start = time.time()
     # Filter estimates
     ehr_estimates = filter_estimates(
-        ehr_estimates=ehr_estimates,
+        ehr_estimates=to_eager(ehr_estimates),
         care_site_level=care_site_level,
         note_type=note_type,
         stay_type=stay_type,
@@ -27,20 +54,29 @@ def estimate_parameters(
         source_system=source_system,
         condition_type=condition_type,
         renaming=False,
+        cached=True,
     )
 
     active_cs_count = ehr_estimates.select(
         "care_site_id"
     ).n_unique()  # Care site with at least one record on the study period
 
-    max_errors = [1.0]
-    max_errors.append(ehr_estimates.select(pl.col("error").quantile(0.75)).item())
-    max_errors.append(ehr_estimates.select(pl.col("error").quantile(0.5)).item())
-    max_errors.append(ehr_estimates.select(pl.col("error").quantile(0.25)).item())
-    min_c_0s = [0.0]
-    min_c_0s.append(ehr_estimates.select(pl.col("c_0").quantile(0.25)).item())
-    min_c_0s.append(ehr_estimates.select(pl.col("c_0").quantile(0.5)).item())
-    min_c_0s.append(ehr_estimates.select(pl.col("c_0").quantile(0.75)).item())
+    # Approximate quantiles: computed on a fixed-size random sample of estimates
+    if quantiles_sample_size and ehr_estimates.height > quantiles_sample_size:
+        ehr_estimates = ehr_estimates.sample(n=quantiles_sample_size, seed=0)
+    # All quantiles are computed in one aggregation
+    quantiles = ehr_estimates.select(
+        [
+            pl.col("error").quantile(quantile).alias("error_{}".format(i))
+            for i, quantile in enumerate(error_quantiles)
+        ]
+        + [
+            pl.col("c_0").quantile(quantile).alias("c_0_{}".format(i))
+            for i, quantile in enumerate(c_0_quantiles)
+        ]
+    ).row(0)
+    max_errors = [1.0, *quantiles[: len(error_quantiles)]]
+    min_c_0s = [0.0, *quantiles[len(error_quantiles) :]]
     end = time.time()
     logger.debug(
         "Estimate max errors ({}) and min c0 ({}): {} s",
@@ -52,8 +88,8 @@ def estimate_parameters(
 
 
 def filter_unstable_cs_from_event_df(
-    event_df: pl.DataFrame,
-    ehr_estimates: pl.DataFrame,
+    event_df: Frame,
+    ehr_estimates: Frame,
     start_observation_date: str,
     care_site_level: str,
     max_error: float = 1.0,
@@ -68,6 +104,8 @@ def filter_unstable_cs_from_event_df(
     visit_col: str = "visit_occurrence_id",
 ):
     start = time.time()
+    lazy = is_lazy(event_df)
+    event_df = event_df.lazy()
     # Filter estimates
     ehr_estimates = filter_estimates(
         ehr_estimates=ehr_estimates,
@@ -87,26 +125,19 @@ def filter_unstable_cs_from_event_df(
         max_error=max_error,
         min_c_0=min_c_0,
         end_date=end_date,
-    )
+    ).lazy()
 
     # Groupby per visit
-    tic = time.time()
-    if care_site_level in ["Unité Fonctionnelle (UF)", "Unité d’hébergement (UH)"]:
-        col_care_site = "detail_care_site_id"
-        if "detail_care_site_level" in event_df.columns:
-            event_df = event_df.filter(
-                pl.col("detail_care_site_level") == care_site_level
-            )
-    elif care_site_level == "Hôpital":
-        col_care_site = "care_site_id"
-    else:
-        return ValueError(
-            "Argument care_site_level must be one of the following : ['Unité Fonctionnelle (UF)', 'Unité d’hébergement (UH)', 'Hôpital']"
-        )
+    col_care_site, event_df = filter_care_site_level(
+        event_df=event_df, care_site_level=care_site_level
+    )
 
     # Count stable cs
     stable_cs_count = (
-        stable_cs.filter(pl.col("stable_cs")).select(col_care_site).n_unique()
+        stable_cs.filter(pl.col("stable_cs"))
+        .select(pl.col(col_care_site).n_unique())
+        .collect()
+        .item()
     )
 
     stable_cs = (
@@ -125,21 +156,44 @@ def filter_unstable_cs_from_event_df(
         .filter(pl.col("stable_cs"))
         .drop("stable_cs")
     )
-    tac = time.time()
-    logger.debug("Groupby per visit: {} s", tac - tic)
 
     # Filter on events
-    tic = time.time()
-    event_df = event_df.join(stable_cs, on=visit_col, how="inner")
-    tac = time.time()
+    event_df = collect(event_df.join(stable_cs, on=visit_col, how="inner"), lazy)
     end = time.time()
-    logger.debug("Filter on events: {} s", tac - tic)
     logger.info("Filter {} on {} level: {} s", visit_col, care_site_level, end - start)
     return stable_cs_count, event_df
 
 
+def filter_care_site_level(event_df: Frame, care_site_level: str):
+    # Care site column of the level, events of other detail levels are removed
+    col_care_site = get_care_site_column(care_site_level)
+    if (
+        col_care_site == "detail_care_site_id"
+        and "detail_care_site_level" in event_df.columns
+    ):
+        event_df = event_df.filter(pl.col("detail_care_site_level") == care_site_level)
+    return col_care_site, event_df
+
+
+def get_care_site_column(care_site_level: str):
+    if care_site_level in ["Unité Fonctionnelle (UF)", "Unité d’hébergement (UH)"]:
+        return "detail_care_site_id"
+    elif care_site_level == "Hôpital":
+        return "care_site_id"
+    raise ValueError(
+        "Argument care_site_level must be one of the following : ['Unité Fonctionnelle (UF)', 'Unité d’hébergement (UH)', 'Hôpital']"
+    )
+
+
+def get_care_site_columns(care_site_level: str):
+    # Event columns read by filter_unstable_cs_from_event_df
+    if care_site_level in ["Unité Fonctionnelle (UF)", "Unité d’hébergement (UH)"]:
+        return ["detail_care_site_id", "detail_care_site_level"]
+    return ["care_site_id"]
+
+
 def filter_unstable_cs_from_estimates(
-    ehr_estimates: pl.DataFrame,
+    ehr_estimates: Frame,
     start_observation_date: str,
     max_error: float = 1.0,
     min_c_0: float = 0.0,
@@ -174,7 +228,7 @@ def filter_unstable_cs_from_estimates(
 
 
 def filter_estimates(
-    ehr_estimates: pl.DataFrame,
+    ehr_estimates: Frame,
     care_site_level: str,
     note_type: str = None,
     stay_type: str = None,
@@ -183,25 +237,32 @@ def filter_estimates(
     source_system: str = None,
     condition_type: str = None,
     renaming: bool = True,
+    cached: bool = False,
     **kwargs
 ):
-    # Filter Estimates
+    # Filter Estimates. With cached, views of eager estimates are cached (for the
+    # estimates shared by every outcome), otherwise estimates are filtered directly
     tic = time.time()
-    ehr_estimates = ehr_estimates.filter(pl.col("care_site_level") == care_site_level)
-    if note_type:
-        ehr_estimates = ehr_estimates.filter(pl.col("note_type") == note_type)
-    if stay_type:
-        ehr_estimates = ehr_estimates.filter(pl.col("stay_type") == stay_type)
-    if specialties_set:
-        ehr_estimates = ehr_estimates.filter(
-            pl.col("specialties_set") == specialties_set
-        )
-    if diag_type:
-        ehr_estimates = ehr_estimates.filter(pl.col("diag_type") == diag_type)
-    if source_system:
-        ehr_estimates = ehr_estimates.filter(pl.col("source_system") == source_system)
-    if condition_type:
-        ehr_estimates = ehr_estimates.filter(pl.col("condition_type") == condition_type)
+    filters = dict(care_site_level=care_site_level)
+    for column, value in dict(
+        note_type=note_type,
+        stay_type=stay_type,
+        specialties_set=specialties_set,
+        diag_type=diag_type,
+        source_system=source_system,
+        condition_type=condition_type,
+    ).items():
+        if value:
+            filters[column] = value
+    if (
+        cached
+        and not is_lazy(ehr_estimates)
+        and set(filters).issubset(ehr_estimates.columns)
+    ):
+        ehr_estimates = _get_estimates_view(ehr_estimates, filters)
+    else:
+        for column, value in filters.items():
+            ehr_estimates = ehr_estimates.filter(pl.col(column) == value)
     if renaming and care_site_level in [
         "Unité Fonctionnelle (UF)",
         "Unité d’hébergement (UH)",
@@ -210,3 +271,81 @@ def filter_estimates(
     tac = time.time()
     logger.debug("Filter Estimates: {} s", tac - tic)
     return ehr_estimates
+
+
+def fingerprint_estimates(ehr_estimates: pl.DataFrame):
+    # Content hash, computed once per estimates object
+    with _estimates_lock:
+        object_id = id(ehr_estimates)
+        if object_id in _estimates_fingerprints:
+            estimates_ref, fingerprint = _estimates_fingerprints[object_id]
+            if estimates_ref() is ehr_estimates:
+                return fingerprint
+        fingerprint = (
+            tuple(ehr_estimates.columns),
+            ehr_estimates.height,
+            hash(tuple(ehr_estimates.hash_rows())),
+        )
+        _estimates_fingerprints[object_id] = (
+            weakref.ref(
+                ehr_estimates,
+                lambda _: _estimates_fingerprints.pop(object_id, None),
+            ),
+            fingerprint,
+        )
+        return fingerprint
+
+
+def _get_estimates_view(ehr_estimates: pl.DataFrame, filters: dict):
+    # Filtered estimates are cached (LRU) and looked up by content and filters
+    fingerprint = fingerprint_estimates(ehr_estimates)
+    view_key = (fingerprint, tuple(sorted(filters.items())))
+    with _estimates_lock:
+        if view_key in _estimates_views:
+            _estimates_views.move_to_end(view_key)
+            return _estimates_views[view_key]
+        partition_columns, partitions = _get_estimates_partitions(
+            ehr_estimates, fingerprint
+        )
+        view = [
+            partition
+            for partition_key, partition in partitions.items()
+            if all(
+                partition_key[partition_columns.index(column)] == value
+                for column, value in filters.items()
+            )
+        ]
+        if not view:
+            view = ehr_estimates.head(0)
+        elif len(view) == 1:
+            view = view[0].drop("estimate_row")
+        else:
+            # Several partitions match: rows are put back in the estimates order
+            view = pl.concat(view).sort("estimate_row").drop("estimate_row")
+        _estimates_views[view_key] = view
+        if len(_estimates_views) > ESTIMATES_VIEWS_CACHE_SIZE:
+            _estimates_views.popitem(last=False)
+        return view
+
+
+def _get_estimates_partitions(ehr_estimates: pl.DataFrame, fingerprint):
+    if fingerprint in _estimates_partitions:
+        _estimates_partitions.move_to_end(fingerprint)
+        return _estimates_partitions[fingerprint]
+    partition_columns = [
+        column
+        for column in ESTIMATES_PARTITION_COLUMNS
+        if column in ehr_estimates.columns
+    ]
+    partitions = {
+        (
+            partition_key if isinstance(partition_key, tuple) else (partition_key,)
+        ): partition
+        for partition_key, partition in ehr_estimates.with_row_count("estimate_row")
+        .partition_by(partition_columns, maintain_order=True, as_dict=True)
+        .items()
+    }
+    _estimates_partitions[fingerprint] = partition_columns, partitions
+    if len(_estimates_partitions) > ESTIMATES_PARTITIONS_CACHE_SIZE:
+        _estimates_partitions.popitem(last=False)
+    return partition_columns, partitions
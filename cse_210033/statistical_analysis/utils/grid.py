@@ -0,0 +1,255 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from itertools import product
+from typing import List
+
+import polars as pl
+from loguru import logger
+
+from .complete_source import (
+    filter_care_site_level,
+    filter_estimates,
+    fingerprint_estimates,
+    get_care_site_column,
+)
+from .lazy import Frame, collect, is_lazy, to_eager
+
+GRID_COLUMNS = ["start_observation_date", "max_error", "min_c_0"]
+TIGHTEST_COLUMNS = ["tightest_t_0", "tightest_error", "tightest_c_0"]
+STABLE_CS_INDEXES_CACHE_SIZE = 64
+
+_stable_cs_indexes = OrderedDict()
+_stable_cs_indexes_lock = threading.Lock()
+
+
+def get_grid(
+    start_observation_dates: List[str],
+    max_errors: List[float],
+    min_c_0s: List[float],
+):
+    # One row per (start_observation_date, max_error, min_c_0) cell
+    return pl.DataFrame(
+        list(product(start_observation_dates, max_errors, min_c_0s)),
+        schema=[
+            ("start_observation_date", pl.Utf8),
+            ("max_error", pl.Float64),
+            ("min_c_0", pl.Float64),
+        ],
+    ).with_columns(
+        pl.col("start_observation_date")
+        .apply(lambda date: datetime.strptime(date, "%Y-%m-%d"))
+        .alias("start_observation_datetime")
+    )
+
+
+def add_tightest_cell(constraints: Frame, grid: Frame):
+    # Tightest grid values satisfied by (t_0, error, c_0), rows never stable are dropped
+    lazy = is_lazy(constraints)
+    constraints, grid = constraints.lazy(), grid.lazy()
+    for col, col_grid, strategy in [
+        ("t_0", "start_observation_datetime", "forward"),
+        ("error", "max_error", "forward"),
+        ("c_0", "min_c_0", "backward"),
+    ]:
+        axis = (
+            grid.select(
+                pl.col(col_grid).cast(constraints.schema[col]).alias("tightest_" + col)
+            )
+            .unique()
+            .sort("tightest_" + col)
+        )
+        constraints = constraints.sort(col).join_asof(
+            axis, left_on=col, right_on="tightest_" + col, strategy=strategy
+        )
+    return collect(constraints.drop_nulls(TIGHTEST_COLUMNS), lazy)
+
+
+def is_stable_in_cell():
+    return (
+        (pl.col("tightest_t_0") <= pl.col("start_observation_datetime"))
+        & (pl.col("tightest_error") <= pl.col("max_error"))
+        & (pl.col("tightest_c_0") >= pl.col("min_c_0"))
+    )
+
+
+def cumulate_over_grid(
+    df: Frame,
+    grid: Frame,
+    index: List[str],
+    aggregations: List[pl.Expr],
+):
+    # Rows are grouped by tightest cell: each cell cumulates every looser group
+    return collect(
+        df.lazy()
+        .join(grid.lazy().unique(subset=GRID_COLUMNS), how="cross")
+        .filter(is_stable_in_cell())
+        .groupby(index + GRID_COLUMNS)
+        .agg(aggregations),
+        is_lazy(df),
+    )
+
+
+def get_stable_cs_index(
+    ehr_estimates: Frame,
+    grid: Frame,
+    care_site_level: str,
+    end_date: str = None,
+    **kwargs
+):
+    # Built once per estimates, filters and grid, then shared by every outcome
+    ehr_estimates = to_eager(ehr_estimates)
+    grid = to_eager(grid)
+    key = (
+        fingerprint_estimates(ehr_estimates),
+        care_site_level,
+        end_date,
+        tuple(sorted((name, value) for name, value in kwargs.items() if value)),
+        tuple(grid.select(GRID_COLUMNS).unique().sort(GRID_COLUMNS).rows()),
+    )
+    with _stable_cs_indexes_lock:
+        if key in _stable_cs_indexes:
+            _stable_cs_indexes.move_to_end(key)
+            return _stable_cs_indexes[key]
+        stable_cs_index = _build_stable_cs_index(
+            ehr_estimates=ehr_estimates,
+            grid=grid,
+            care_site_level=care_site_level,
+            end_date=end_date,
+            **kwargs,
+        )
+        _stable_cs_indexes[key] = stable_cs_index
+        if len(_stable_cs_indexes) > STABLE_CS_INDEXES_CACHE_SIZE:
+            _stable_cs_indexes.popitem(last=False)
+        return stable_cs_index
+
+
+def _build_stable_cs_index(
+    ehr_estimates: pl.DataFrame,
+    grid: pl.DataFrame,
+    care_site_level: str,
+    end_date: str = None,
+    **kwargs
+):
+    # Stability is monotone in t_0, error and c_0: the stable cells of a care site
+    # are all the cells looser than its tightest cell
+    tic = time.time()
+    col_care_site = get_care_site_column(care_site_level)
+    ehr_estimates = _add_eligibility(
+        filter_estimates(
+            ehr_estimates=ehr_estimates,
+            care_site_level=care_site_level,
+            cached=True,
+            **kwargs,
+        ),
+        end_date=end_date,
+    ).with_columns(pl.col(col_care_site).cast(pl.Int64))
+    stable_estimates = add_tightest_cell(ehr_estimates.filter(pl.col("eligible")), grid)
+
+    # Count care sites with a stable estimate per cell
+    stable_cs_count = (
+        grid.select(GRID_COLUMNS)
+        .unique()
+        .join(
+            cumulate_over_grid(
+                stable_estimates,
+                grid=grid,
+                index=[],
+                aggregations=[pl.col(col_care_site).n_unique().alias("cso_cs_count")],
+            ),
+            on=GRID_COLUMNS,
+            how="left",
+        )
+        .with_columns(pl.col("cso_cs_count").fill_null(0))
+    )
+
+    # Care site index: every estimate of the care site must be stable
+    stable_cs_index = (
+        stable_estimates.groupby(col_care_site)
+        .agg(
+            [
+                pl.col("tightest_t_0").max(),
+                pl.col("tightest_error").max(),
+                pl.col("tightest_c_0").min(),
+                pl.count().alias("n_stable_estimates"),
+            ]
+        )
+        .join(
+            ehr_estimates.groupby(col_care_site).agg(pl.count().alias("n_estimates")),
+            on=col_care_site,
+        )
+        .filter(pl.col("n_stable_estimates") == pl.col("n_estimates"))
+        .select([col_care_site] + TIGHTEST_COLUMNS)
+    )
+    tac = time.time()
+    logger.debug("Build stable care site index: {} s", tac - tic)
+    return stable_cs_count, stable_cs_index
+
+
+def get_stability_constraints(
+    event_df: Frame,
+    ehr_estimates: Frame,
+    grid: Frame,
+    care_site_level: str,
+    end_date: str = None,
+    visit_col: str = "visit_occurrence_id",
+    **kwargs
+):
+    start = time.time()
+    lazy = is_lazy(event_df, ehr_estimates)
+    stable_cs_count, stable_cs_index = get_stable_cs_index(
+        ehr_estimates=ehr_estimates,
+        grid=grid,
+        care_site_level=care_site_level,
+        end_date=end_date,
+        **kwargs,
+    )
+    col_care_site, event_df = filter_care_site_level(
+        event_df=event_df.lazy(), care_site_level=care_site_level
+    )
+
+    # A visit is stable when every care site of its events is stable: the tightest
+    # cell of the visit is the loosest bound over its care sites
+    constraints = (
+        event_df.with_columns(pl.col(col_care_site).cast(pl.Int64))
+        .select(pl.col([visit_col, col_care_site]))
+        .join(stable_cs_index.lazy(), on=col_care_site, how="left")
+        .groupby(visit_col)
+        .agg(
+            [
+                pl.col("tightest_t_0").max(),
+                pl.col("tightest_error").max(),
+                pl.col("tightest_c_0").min(),
+                pl.col("tightest_t_0").null_count().alias("n_unstable_cs"),
+            ]
+        )
+        .filter(pl.col("n_unstable_cs") == 0)
+        .drop("n_unstable_cs")
+    )
+    if lazy:
+        stable_cs_count = stable_cs_count.lazy()
+    else:
+        event_df, constraints = pl.collect_all([event_df, constraints])
+    end = time.time()
+    logger.info(
+        "Stability constraints of {} on {} level: {} s",
+        visit_col,
+        care_site_level,
+        end - start,
+    )
+    return stable_cs_count, event_df, constraints
+
+
+def _add_eligibility(ehr_estimates: Frame, end_date: str = None):
+    # Estimates with a missing parameter or ending too early are never stable
+    eligible = (
+        pl.col("t_0").is_not_null()
+        & pl.col("error").is_not_null()
+        & pl.col("c_0").is_not_null()
+    )
+    if "t_1" in ehr_estimates.columns and end_date:
+        eligible = eligible & (
+            pl.col("t_1") >= datetime.strptime(end_date, "%Y-%m-%d")
+        ).fill_null(False)
+    return ehr_estimates.with_columns(eligible.alias("eligible"))
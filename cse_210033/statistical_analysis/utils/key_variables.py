@@ -1,23 +1,33 @@
 import time
 from datetime import timedelta
-from typing import List
+from functools import reduce
+from itertools import combinations
+from operator import and_
+from typing import Dict, List
 
 import polars as pl
 from loguru import logger
 
+from .grid import GRID_COLUMNS, TIGHTEST_COLUMNS, cumulate_over_grid, is_stable_in_cell
+from .lazy import Frame, collect, is_lazy
+
+# Each key function builds a single query plan, collected once for eager inputs
+
 
 def compute_duration_after_event(
-    event_df: pl.DataFrame,
-    cohort_visit: pl.DataFrame,
+    event_df: Frame,
+    cohort_visit: Frame,
     col_date: str,
     thresholds: List[float],
     sensibility_variables: List[str],
+    totals: Dict[str, str] = None,
 ):
     start = time.time()
+    lazy = is_lazy(event_df, cohort_visit)
+    event_df, cohort_visit = event_df.lazy(), cohort_visit.lazy()
     index = sensibility_variables.copy() if sensibility_variables else []
     index.append("sub_cohort")
     # Merge event and cohort per patient
-    tic = time.time()
     event_per_cohort_stay = cohort_visit.select(
         pl.col(
             [
@@ -37,82 +47,65 @@ def compute_duration_after_event(
         strategy="forward",
         tolerance="{}d".format(max(thresholds)),
     )
-    tac = time.time()
-    logger.debug("Merge event and cohort: {} s", tac - tic)
 
     # Remove cohort stay in outcome
-    tic = time.time()
     event_per_cohort_stay = event_per_cohort_stay.filter(
         ~(pl.col("visit_cohort_id") == pl.col("visit_occurrence_id"))
         & (pl.col(col_date).is_not_null())
     )
-    tac = time.time()
-    logger.debug("Remove cohort stay in outcome: {} s", tac - tic)
 
     # Compute time difference between event and cohort stay
-    tic = time.time()
     event_per_cohort_stay = event_per_cohort_stay.with_columns(
         (pl.col(col_date) - pl.col("cohort_stay_end")).alias(
             "duration_after_cohort_stay"
         )
     )
-    tac = time.time()
-    logger.debug("Compute time difference: {} s", tac - tic)
-
-    # Thresholds
-    tic = time.time()
-    outcome_per_threshold = []
-    for threshold in thresholds:
-        outcome = event_per_cohort_stay.clone()
-        outcome = outcome.with_columns(
-            pl.when(pl.col("duration_after_cohort_stay") <= timedelta(days=threshold))
-            .then(True)
-            .otherwise(False)
-            .alias("has_event"),
-            pl.lit("before_{}_days".format(threshold)).alias("threshold"),
-        )
-        outcome_per_threshold.append(outcome)
 
-    result = pl.concat(outcome_per_threshold)
-    tac = time.time()
-    logger.debug("Concat thresholds: {} s", tac - tic)
-
-    # Sum events
-    tic = time.time()
-    result = (
-        result.groupby(index + ["threshold"])
-        .agg([pl.col("has_event").sum().alias("n_events")])
-        .with_columns(pl.col("n_events").cast(pl.Int32))
+    # Sum events per threshold
+    result = count_events_per_threshold(
+        event_per_cohort_stay, index=index, thresholds=thresholds
     )
-    tac = time.time()
-    logger.debug("Sum events: {} s", tac - tic)
 
     # Compute rate
-    tic = time.time()
-    result = result.join(
-        cohort_visit.groupby(index).agg(
-            pl.col("visit_cohort_id").count().alias("n_total")
-        ),
-        on=index,
-    ).with_columns((pl.col("n_events") / pl.col("n_total")).alias("rate"))
-    tac = time.time()
-    logger.debug("Compute rate: {} s", tac - tic)
+    result = (
+        add_totals(
+            result,
+            index=index + ["threshold"],
+            totals=totals,
+            aggregations=[pl.col("n_events").sum()],
+        )
+        .join(
+            add_totals(
+                cohort_visit.groupby(index).agg(
+                    pl.col("visit_cohort_id").count().alias("n_total")
+                ),
+                index=index,
+                totals=totals,
+                aggregations=[pl.col("n_total").sum()],
+            ),
+            on=index,
+        )
+        .with_columns((pl.col("n_events") / pl.col("n_total")).alias("rate"))
+    )
+    result = collect(result, lazy)
     end = time.time()
     logger.info("Compute duration: {} s", end - start)
     return result
 
 
 def compute_event_during_cohort_stay(
-    event_df: pl.DataFrame,
-    cohort_visit: pl.DataFrame,
+    event_df: Frame,
+    cohort_visit: Frame,
     sensibility_variables: List[str],
+    totals: Dict[str, str] = None,
     **kwargs
 ):
     start = time.time()
+    lazy = is_lazy(event_df, cohort_visit)
+    event_df, cohort_visit = event_df.lazy(), cohort_visit.lazy()
     index = sensibility_variables.copy() if sensibility_variables else []
     index.append("sub_cohort")
     # Merge event and cohort per patient
-    tic = time.time()
     event_df = (
         event_df.rename({"visit_occurrence_id": "visit_cohort_id"})
         .with_columns(pl.lit(True).alias("has_event"))
@@ -120,12 +113,9 @@ def compute_event_during_cohort_stay(
         .unique()
     )
     result = cohort_visit.join(event_df, on="visit_cohort_id", how="left")
-    tac = time.time()
-    logger.debug("Merge event and cohort: {} s", tac - tic)
 
     # Compute rate
-    tic = time.time()
-    result = (
+    result = add_totals(
         result.groupby(index)
         .agg(
             [
@@ -135,72 +125,376 @@ def compute_event_during_cohort_stay(
         )
         .with_columns(
             pl.col("n_events").fill_null(strategy="zero").cast(pl.Int32),
-        )
-        .with_columns((pl.col("n_events") / pl.col("n_total")).alias("rate"))
-    )
-    tac = time.time()
-    logger.debug("Compute rate: {} s", tac - tic)
+        ),
+        index=index,
+        totals=totals,
+        aggregations=[pl.col("n_events").sum(), pl.col("n_total").sum()],
+    ).with_columns((pl.col("n_events") / pl.col("n_total")).alias("rate"))
+    result = collect(result, lazy)
     end = time.time()
     logger.info("Compute during: {} s", end - start)
     return result
 
 
 def compute_condition_incidence(
-    event_df: pl.DataFrame,
-    cohort_visit: pl.DataFrame,
+    event_df: Frame,
+    cohort_visit: Frame,
     sensibility_variables: List[str],
+    totals: Dict[str, str] = None,
     **kwargs
 ):
     start = time.time()
-    index_time = "cohort_stay_start"
+    lazy = is_lazy(event_df, cohort_visit)
+    event_df, cohort_visit = event_df.lazy(), cohort_visit.lazy()
 
     # Merge event and cohort per patient
-    tic = time.time()
     event_df = (
         event_df.rename({"visit_occurrence_id": "visit_cohort_id"})
         .select(pl.col(["visit_cohort_id"]))
         .unique()
     )
     result = cohort_visit.join(event_df, on="visit_cohort_id", how="inner")
-    tac = time.time()
-    logger.debug("Merge event and cohort: {} s", tac - tic)
 
     # Sum events
-    tic = time.time()
-    result = (
-        result.sort(index_time)
-        .groupby_dynamic(index_time, every="1w", by=sensibility_variables)
+    index = sensibility_variables.copy() if sensibility_variables else []
+    result = count_weekly_events(result, index=index, totals=totals)
+
+    # Compute max_event per-winter
+    result = collect(_add_max_events_per_winter(result, index), lazy)
+    end = time.time()
+    logger.info("Compute incidence: {} s", end - start)
+    return result
+
+
+def count_weekly_events(
+    cohort_visit: pl.LazyFrame,
+    index: List[str],
+    totals: Dict[str, str] = None,
+    index_time: str = "cohort_stay_start",
+):
+    # Weekly windows start at the first event of each group, so weekly counts do not
+    # add up across groups: every grouping set is aggregated from the cohort stays
+    cohort_visit = cohort_visit.sort(index_time)
+    grouping_sets = get_grouping_sets(index, totals)
+    results = [
+        cohort_visit.groupby_dynamic(index_time, every="1w", by=by or None)
         .agg([pl.col("visit_cohort_id").n_unique().alias("n_events")])
-        .with_columns(pl.col("n_events").cast(pl.Int32))
+        .with_columns(
+            [pl.col("n_events").cast(pl.Int32)]
+            + [pl.lit(label).alias(column) for column, label in labels.items()]
+        )
         .rename({index_time: "sub_cohort"})
+        for by, labels in grouping_sets
+    ]
+    if len(results) == 1:
+        return results[0]
+    return _concat_totals(results, total_columns=list(grouping_sets[-1][1]))
+
+
+def add_totals(
+    result: pl.LazyFrame,
+    index: List[str],
+    totals: Dict[str, str] = None,
+    aggregations: List[pl.Expr] = [],
+):
+    # Grouping sets: rows of each combination of totals (e.g. care_site_id="All") are
+    # aggregated from the partial aggregates per index, cohort stays are never
+    # duplicated
+    grouping_sets = get_grouping_sets(index, totals)
+    if len(grouping_sets) == 1:
+        return result
+    results = [result] + [
+        result.groupby(by)
+        .agg(aggregations)
+        .with_columns([pl.lit(label).alias(column) for column, label in labels.items()])
+        for by, labels in grouping_sets[1:]
+    ]
+    return _concat_totals(results, total_columns=list(grouping_sets[-1][1]))
+
+
+def get_grouping_sets(index: List[str], totals: Dict[str, str] = None):
+    # Cube over the totals found in the index, from the finest grouping set to the
+    # grouping set where every total is aggregated
+    totals = {
+        column: label for column, label in (totals or {}).items() if column in index
+    }
+    return [
+        (
+            [column for column in index if column not in combination],
+            {column: totals[column] for column in combination},
+        )
+        for n_totals in range(len(totals) + 1)
+        for combination in combinations(totals, n_totals)
+    ]
+
+
+def _concat_totals(results: List[pl.LazyFrame], total_columns: List[str]):
+    # Total columns become strings, other columns keep the fine-grained types. Stays
+    # with a null total column (e.g. MCD out of scope) only count in its total rows
+    totals_schema = results[0].schema
+    for column in total_columns:
+        totals_schema[column] = pl.Utf8
+    return pl.concat(
+        [
+            result.select(
+                [pl.col(column).cast(dtype) for column, dtype in totals_schema.items()]
+            )
+            for result in results
+        ]
+    ).filter(reduce(and_, [pl.col(column).is_not_null() for column in total_columns]))
+
+
+def count_events_per_threshold(
+    event_per_cohort_stay: pl.LazyFrame,
+    index: List[str],
+    thresholds: List[float],
+    col_duration: str = "duration_after_cohort_stay",
+):
+    # Durations are binned once against the sorted thresholds, then bin counts are
+    # cumulated: a cohort stay counts for its bin threshold and every larger one
+    thresholds = sorted(thresholds)
+    threshold_bins = pl.DataFrame(
+        dict(
+            threshold=["before_{}_days".format(threshold) for threshold in thresholds],
+            threshold_bin_max=list(range(len(thresholds))),
+        ),
+        schema_overrides=dict(threshold_bin_max=pl.UInt32),
+    ).lazy()
+    threshold_durations = pl.Series(
+        [timedelta(days=threshold) for threshold in thresholds]
+    ).cast(event_per_cohort_stay.schema[col_duration])
+    return (
+        event_per_cohort_stay.with_columns(
+            pl.lit(threshold_durations)
+            .search_sorted(pl.col(col_duration))
+            .alias("threshold_bin")
+        )
+        .groupby(index + ["threshold_bin"])
+        .agg(pl.count().alias("n_bin_events"))
+        .join(threshold_bins, how="cross")
+        .with_columns(
+            pl.when(pl.col("threshold_bin") <= pl.col("threshold_bin_max"))
+            .then(pl.col("n_bin_events"))
+            .otherwise(0)
+            .alias("n_events")
+        )
+        .groupby(index + ["threshold"])
+        .agg(pl.col("n_events").sum())
+        .with_columns(pl.col("n_events").cast(pl.Int32))
     )
-    tac = time.time()
-    logger.debug("Sum events: {} s", tac - tic)
 
-    # Compute max_event per-winter
-    tic = time.time()
+
+def _add_max_events_per_winter(result: pl.LazyFrame, index: List[str]):
     result = result.with_columns(
         (pl.col("sub_cohort").dt.year() + (pl.col("sub_cohort").dt.month() > 8)).alias(
             "school_years"
         )
     )
-    index = sensibility_variables.copy() if sensibility_variables else []
     result_max = (
         result.sort(["n_events", "sub_cohort"], descending=[True, False])
         .groupby(["school_years"] + index)
         .first()
         .rename({"n_events": "max_events"})
     )
-    tac = time.time()
-    logger.debug("Compute max_event per-winter: {} s", tac - tic)
-
-    # Join to result
-    tic = time.time()
-    result = result.join(
+    return result.join(
         result_max, on=["sub_cohort", "school_years"] + index, how="left"
     )
-    tac = time.time()
-    logger.debug("Join to result: {} s", tac - tic)
+
+
+def compute_duration_after_event_over_grid(
+    event_df: Frame,
+    constraints: Frame,
+    grid: Frame,
+    cohort_visit: Frame,
+    col_date: str,
+    thresholds: List[float],
+    sensibility_variables: List[str],
+    totals: Dict[str, str] = None,
+):
+    start = time.time()
+    lazy = is_lazy(event_df, constraints, cohort_visit)
+    event_df, constraints, grid, cohort_visit = (
+        event_df.lazy(),
+        constraints.lazy(),
+        grid.lazy(),
+        cohort_visit.lazy(),
+    )
+    index = sensibility_variables.copy() if sensibility_variables else []
+    index.append("sub_cohort")
+    # Stable events in the max threshold after each cohort stay
+    candidates = (
+        cohort_visit.select(
+            pl.col(["visit_cohort_id", "person_id", "cohort_stay_end"] + index)
+        )
+        .with_row_count("cohort_stay_row")
+        .join(
+            event_df.select(pl.col(["visit_occurrence_id", "person_id", col_date]))
+            .filter(pl.col(col_date).is_not_null())
+            .join(constraints, on="visit_occurrence_id", how="inner"),
+            on="person_id",
+            how="inner",
+        )
+        .with_columns(
+            (pl.col(col_date) - pl.col("cohort_stay_end")).alias(
+                "duration_after_cohort_stay"
+            )
+        )
+        .filter(
+            (pl.col("duration_after_cohort_stay") >= timedelta(0))
+            & (pl.col("duration_after_cohort_stay") <= timedelta(days=max(thresholds)))
+        )
+        # Events with the same tightest cell are stable in the same cells: only the
+        # first event per cohort stay and tightest cell is expanded over the grid
+        .sort(col_date)
+        .groupby(["cohort_stay_row"] + TIGHTEST_COLUMNS)
+        .first()
+    )
+    # Cells where each tightest cell is stable
+    stable_cells = (
+        constraints.select(TIGHTEST_COLUMNS)
+        .unique()
+        .join(grid.select(GRID_COLUMNS + ["start_observation_datetime"]), how="cross")
+        .filter(is_stable_in_cell())
+        .select(TIGHTEST_COLUMNS + GRID_COLUMNS)
+        .unique()
+    )
+
+    # First stable event per cohort stay and cell, cohort stay in outcome removed
+    event_per_cohort_stay = (
+        candidates.join(stable_cells, on=TIGHTEST_COLUMNS, how="inner")
+        .sort(col_date)
+        .groupby(["cohort_stay_row"] + GRID_COLUMNS)
+        .first()
+        .filter(~(pl.col("visit_cohort_id") == pl.col("visit_occurrence_id")))
+    )
+
+    # Sum events per threshold
+    result = count_events_per_threshold(
+        event_per_cohort_stay, index=index + GRID_COLUMNS, thresholds=thresholds
+    )
+
+    # Compute rate
+    result = (
+        add_totals(
+            result,
+            index=index + GRID_COLUMNS + ["threshold"],
+            totals=totals,
+            aggregations=[pl.col("n_events").sum()],
+        )
+        .join(
+            add_totals(
+                cohort_visit.groupby(index).agg(
+                    pl.col("visit_cohort_id").count().alias("n_total")
+                ),
+                index=index,
+                totals=totals,
+                aggregations=[pl.col("n_total").sum()],
+            ),
+            on=index,
+        )
+        .with_columns((pl.col("n_events") / pl.col("n_total")).alias("rate"))
+    )
+    result = collect(result, lazy)
     end = time.time()
-    logger.info("Compute incidence: {} s", end - start)
+    logger.info("Compute duration over grid: {} s", end - start)
+    return result
+
+
+def compute_event_during_cohort_stay_over_grid(
+    constraints: Frame,
+    grid: Frame,
+    cohort_visit: Frame,
+    sensibility_variables: List[str],
+    totals: Dict[str, str] = None,
+    **kwargs
+):
+    start = time.time()
+    lazy = is_lazy(constraints, cohort_visit)
+    constraints, grid, cohort_visit = (
+        constraints.lazy(),
+        grid.lazy(),
+        cohort_visit.lazy(),
+    )
+    index = sensibility_variables.copy() if sensibility_variables else []
+    index.append("sub_cohort")
+    # Count cohort stays with a stable event per tightest cell
+    n_events = cumulate_over_grid(
+        cohort_visit.join(
+            constraints.rename({"visit_occurrence_id": "visit_cohort_id"}),
+            on="visit_cohort_id",
+            how="inner",
+        )
+        .groupby(index + TIGHTEST_COLUMNS)
+        .agg(pl.count().alias("n_events")),
+        grid=grid,
+        index=index,
+        aggregations=[pl.col("n_events").sum()],
+    )
+
+    # Compute rate
+    result = (
+        add_totals(
+            cohort_visit.groupby(index).agg(
+                pl.col("visit_cohort_id").n_unique().alias("n_total")
+            ),
+            index=index,
+            totals=totals,
+            aggregations=[pl.col("n_total").sum()],
+        )
+        .join(grid.select(GRID_COLUMNS).unique(), how="cross")
+        .join(
+            add_totals(
+                n_events,
+                index=index + GRID_COLUMNS,
+                totals=totals,
+                aggregations=[pl.col("n_events").sum()],
+            ),
+            on=index + GRID_COLUMNS,
+            how="left",
+        )
+        .with_columns(
+            pl.col("n_events").fill_null(strategy="zero").cast(pl.Int32),
+        )
+        .with_columns((pl.col("n_events") / pl.col("n_total")).alias("rate"))
+    )
+    result = collect(result, lazy)
+    end = time.time()
+    logger.info("Compute during over grid: {} s", end - start)
+    return result
+
+
+def compute_condition_incidence_over_grid(
+    constraints: Frame,
+    grid: Frame,
+    cohort_visit: Frame,
+    sensibility_variables: List[str],
+    totals: Dict[str, str] = None,
+    **kwargs
+):
+    start = time.time()
+    lazy = is_lazy(constraints, cohort_visit)
+    constraints, grid, cohort_visit = (
+        constraints.lazy(),
+        grid.lazy(),
+        cohort_visit.lazy(),
+    )
+    index = sensibility_variables.copy() if sensibility_variables else []
+
+    # Sum events per week and cell (weekly windows start at the first event of a group)
+    result = count_weekly_events(
+        cohort_visit.join(
+            constraints.rename({"visit_occurrence_id": "visit_cohort_id"}),
+            on="visit_cohort_id",
+            how="inner",
+        )
+        .join(grid.unique(subset=GRID_COLUMNS), how="cross")
+        .filter(is_stable_in_cell()),
+        index=index + GRID_COLUMNS,
+        totals=totals,
+    )
+
+    # Compute max_event per-winter
+    result = collect(_add_max_events_per_winter(result, index + GRID_COLUMNS), lazy)
+    end = time.time()
+    logger.info("Compute incidence over grid: {} s", end - start)
     return result
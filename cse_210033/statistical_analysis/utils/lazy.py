@@ -0,0 +1,19 @@
+from typing import Union
+
+import polars as pl
+
+Frame = Union[pl.DataFrame, pl.LazyFrame]
+
+
+def is_lazy(*frames: Frame):
+    return any(isinstance(frame, pl.LazyFrame) for frame in frames)
+
+
+def collect(frame: pl.LazyFrame, lazy: bool):
+    # Lazy callers get the query plan back, eager callers (e.g. notebooks) the result
+    return frame if lazy else frame.collect()
+
+
+def to_eager(frame: Frame) -> pl.DataFrame:
+    # Eager frames are returned unchanged so that their fingerprint stays cached
+    return frame.collect() if is_lazy(frame) else frame
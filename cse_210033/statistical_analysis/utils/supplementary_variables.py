@@ -1,39 +1,27 @@
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
 import polars as pl
-import statsmodels.api as sm
 from edsteva.utils.typing import DataFrame
+from scipy import stats
 
+from .lazy import Frame
 
-def add_mcd(cohort_visit: pl.DataFrame):
-    cohort_visit_all = (
-        cohort_visit.drop(["CMD", "CMD_code"])
-        .clone()
-        .with_columns(pl.lit("00 ALL").alias("MCD"))
-    )
-    cohort_visit_mcd = (
-        cohort_visit.filter(
+
+def add_mcd(cohort_visit: Frame):
+    # MCD is null out of scope, these stays only count in the "00 ALL" total rows
+    # (see the totals of the key functions)
+    return cohort_visit.with_columns(
+        pl.when(
             (pl.col("CMD_code") <= "27")
             & (pl.col("sub_cohort") >= datetime(2016, 1, 1))
         )
-        .with_columns((pl.col("CMD_code") + " " + pl.col("CMD")).alias("MCD"))
-        .drop(["CMD", "CMD_code"])
-    )
-
-    return cohort_visit_mcd, cohort_visit_all
-
-
-def add_care_site(cohort_visit: pl.DataFrame):
-    cohort_visit = cohort_visit.with_columns(pl.col("care_site_id").cast(str))
-    cohort_visit_all = (
-        cohort_visit.drop(["care_site_id"])
-        .clone()
-        .with_columns(pl.lit("All").alias("care_site_id"))
-    )
-    cohort_visit = pl.concat([cohort_visit, cohort_visit_all], how="diagonal")
-
-    return cohort_visit
+        .then(pl.col("CMD_code") + " " + pl.col("CMD"))
+        .otherwise(None)
+        .alias("MCD")
+    ).drop(["CMD", "CMD_code"])
 
 
 def t_test(
@@ -41,6 +29,7 @@ def t_test(
     y_col: str,
     x_col: str,
     as_string: bool = False,
+    n_jobs: int = 1,
     **kwargs,
 ):
     index = list(
@@ -59,6 +48,7 @@ def t_test(
 
     # Fill na
     end_date = data.sub_cohort.max()
+    data = data[[*index, x_col, y_col]]
     filled_data = []
     for start_observation_date in data.start_observation_date.unique():
         date_index = pd.date_range(
@@ -82,64 +72,80 @@ def t_test(
             ).fillna(0)
         )
     filled_data = pd.concat(filled_data)
-    iter = filled_data.groupby(index, dropna=False)
-    results = []
-    for partition, group in iter:
-        row = dict(zip(index, partition))
-        p_value, alpha_0, alpha_1, mean_value = _compute_one_t_test(
-            group, x_col, y_col, as_string
-        )
-        row["p_value"] = p_value
-        row["alpha_0"] = alpha_0
-        row["alpha_1"] = alpha_1
-        row["mean_value"] = mean_value
-        results.append(row)
-    return pd.DataFrame(results)
 
+    # Each partition is regressed on its month rank, all partitions at once
+    filled_data["group"] = filled_data.groupby(index, dropna=False).ngroup()
+    filled_data = filled_data.sort_values(["group", x_col])
+    filled_data["x"] = filled_data.groupby("group").cumcount()
+    filled_data["y"] = filled_data[y_col].astype(float)
+    trends = filled_data[["group", "x", "y"]]
+    if n_jobs > 1:
+        shards = [trends[trends.group % n_jobs == shard] for shard in range(n_jobs)]
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            trends = pd.concat(executor.map(_fit_linear_trends, shards))
+    else:
+        trends = _fit_linear_trends(trends)
+    trends = trends.sort_index()
 
-def _compute_one_t_test(
-    group: DataFrame,
-    x_col: str,
-    y_col: str,
-    as_string: bool,
-):
-    X = list(range(group.shape[0]))
-    try:
-        X = sm.add_constant(X)
-    except ValueError:
-        p_value = "NOT SPECIFIED"
-        alpha_0 = "NOT SPECIFIED"
-        alpha_1 = "NOT SPECIFIED"
-        return p_value, alpha_0, alpha_1
-    y = group.sort_values(x_col)[y_col]
-    model = sm.OLS(y.astype(float), X.astype(float))
-    fitted_model = model.fit()
+    results = filled_data.drop_duplicates("group").set_index("group")[index]
+    results["p_value"] = trends.p_value
+    results["alpha_0"] = trends.alpha_0
+    results["alpha_1"] = trends.alpha_1
     if as_string:
-        # p_value
-        p_value = fitted_model.pvalues[1]
-        if p_value < 0.001:
-            p_value = "< 10e-3"
-        else:
-            p_value = f"{p_value:.3f}"
+        results["p_value"] = trends.p_value.map(
+            lambda p_value: "< 10e-3" if p_value < 0.001 else f"{p_value:.3f}"
+        )
+        for alpha in ["alpha_0", "alpha_1"]:
+            results[alpha] = (
+                trends[alpha].map("{:.2e}".format)
+                + " ["
+                + trends[alpha + "_ci_inf"].map("{:.2e}".format)
+                + ", "
+                + trends[alpha + "_ci_sup"].map("{:.2e}".format)
+                + "]"
+            )
+    results["mean_value"] = trends.mean_value
+    return results.reset_index(drop=True)
 
-        # alpha_0
-        alpha_0 = f"{fitted_model.params[0]:.2e}"
-        ci_inf = f"{fitted_model.conf_int().iloc[0, 0]:.2e}"
-        ci_sup = f"{fitted_model.conf_int().iloc[0, 1]:.2e}"
-        alpha_0 = alpha_0 + " [" + ci_inf + ", " + ci_sup + "]"
 
-        # alpha_1
-        alpha_1 = f"{fitted_model.params[1]:.2e}"
-        ci_inf = f"{fitted_model.conf_int().iloc[1, 0]:.2e}"
-        ci_sup = f"{fitted_model.conf_int().iloc[1, 1]:.2e}"
-        alpha_1 = alpha_1 + " [" + ci_inf + ", " + ci_sup + "]"
-    else:
-        # p_value
-        p_value = fitted_model.pvalues[1]
-        # alpha_0
-        alpha_0 = fitted_model.params[0]
-        # alpha_1
-        alpha_1 = fitted_model.params[1]
+def _fit_linear_trends(trends: pd.DataFrame, alpha: float = 0.05):
+    # Closed-form OLS of y on [1, x] per group, same estimates as statsmodels OLS
+    groups = trends.groupby("group")
+    x_mean = groups.x.transform("mean")
+    y_mean = groups.y.transform("mean")
+    trends = trends.assign(
+        x_centered=trends.x - x_mean,
+        y_centered=trends.y - y_mean,
+    )
+    trends = trends.assign(
+        xx=trends.x_centered**2,
+        xy=trends.x_centered * trends.y_centered,
+    )
+    sums = trends.groupby("group").agg(
+        n=("x", "size"),
+        x_mean=("x", "mean"),
+        mean_value=("y", "mean"),
+        xx=("xx", "sum"),
+        xy=("xy", "sum"),
+    )
+    # A single month has no slope (minimum norm solution, as the pseudo-inverse)
+    sums["alpha_1"] = (sums.xy / sums.xx.where(sums.xx > 0)).fillna(0)
+    sums["alpha_0"] = sums.mean_value - sums.alpha_1 * sums.x_mean
 
-    mean_value = group[y_col].mean()
-    return p_value, alpha_0, alpha_1, mean_value
+    # Residuals and standard errors
+    trends["residual"] = trends.y_centered - trends.x_centered * trends.group.map(
+        sums.alpha_1
+    )
+    sums["ssr"] = (trends.residual**2).groupby(trends.group).sum()
+    df_resid = sums.n - 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = sums.ssr / df_resid
+        bse_1 = np.sqrt(scale / sums.xx)
+        bse_0 = np.sqrt(scale * (1 / sums.n + sums.x_mean**2 / sums.xx))
+        t_1 = sums.alpha_1 / bse_1
+    sums["p_value"] = 2 * stats.t.sf(np.abs(t_1), df_resid)
+    q = stats.t.ppf(1 - alpha / 2, df_resid)
+    for param, bse in [("alpha_0", bse_0), ("alpha_1", bse_1)]:
+        sums[param + "_ci_inf"] = sums[param] - q * bse
+        sums[param + "_ci_sup"] = sums[param] + q * bse
+    return sums
@@ -1,9 +1,19 @@
 import datetime
 import json
 import os
+import shutil
+import threading
 import time
+from contextlib import contextmanager
 from datetime import timedelta
+from pathlib import Path
+from typing import Any, List
 
+import numpy as np
+import pandas as pd
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
 from loguru import logger
 
 from cse_210033 import BASE_DIR
@@ -14,6 +24,161 @@ def dump_data(data, path):
         json.dump(data, f)
 
 
+def read_data(path, default=None):
+    if not os.path.isfile(path):
+        return default
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def shift_month(month: str, n_months: int):
+    return (pd.Timestamp(month) + pd.DateOffset(months=n_months)).strftime("%Y-%m-01")
+
+
+def get_refresh_month(watermark: str, look_back_months: int):
+    # A missing or null watermark (nothing dated saved yet) means a full rebuild
+    if watermark is None:
+        return None
+    return shift_month(watermark, -look_back_months)
+
+
+def save_partitions(
+    df: pd.DataFrame,
+    folder_path: Path,
+    col_date: str,
+    refresh_month: str = None,
+):
+    # One Parquet file per month of col_date, undated rows are rewritten on each save
+    months = df[col_date].dt.strftime("%Y-%m-01").fillna("undated")
+    is_dated = months != "undated"
+    if refresh_month is None:
+        if os.path.isdir(folder_path):
+            shutil.rmtree(folder_path)
+    else:
+        # "undated" sorts after every month, so it is replaced as well
+        for partition_path in folder_path.glob("*.parquet"):
+            if partition_path.stem >= refresh_month:
+                os.remove(partition_path)
+        is_dated = is_dated & (months >= refresh_month)
+    os.makedirs(folder_path, exist_ok=True)
+    # Rows are sorted by month and converted once to Arrow: every partition shares the
+    # same schema and is a slice of the table
+    order = np.argsort(months.to_numpy(), kind="stable")
+    months, is_dated = months.to_numpy()[order], is_dated.to_numpy()[order]
+    table = pa.Table.from_pandas(df.iloc[order], preserve_index=False)
+    schema = pa.schema(
+        [
+            pa.field(
+                field.name,
+                pa.timestamp("us", tz=field.type.tz),
+                field.nullable,
+                field.metadata,
+            )
+            if pa.types.is_timestamp(field.type)
+            else field
+            for field in table.schema
+        ]
+    )
+    kept_partitions = sorted(folder_path.glob("*.parquet"))
+    if kept_partitions:
+        kept_schema = pq.read_schema(kept_partitions[0])
+        schema = _promote_null_fields(kept_schema, schema)
+        if not schema.equals(kept_schema):
+            # Columns that were only null so far get the type of the new rows
+            for partition_path in kept_partitions:
+                pq.write_table(
+                    pq.read_table(partition_path).cast(schema), partition_path
+                )
+    table = table.cast(schema)
+    for month in [*np.unique(months[is_dated]), "undated"]:
+        start = np.searchsorted(months, month, side="left")
+        end = np.searchsorted(months, month, side="right")
+        pq.write_table(
+            table.slice(start, end - start), folder_path / "{}.parquet".format(month)
+        )
+    dated_months = sorted(
+        partition_path.stem
+        for partition_path in folder_path.glob("*.parquet")
+        if partition_path.stem != "undated"
+    )
+    return dated_months[-1] if dated_months else None
+
+
+def _promote_null_fields(schema: pa.Schema, new_schema: pa.Schema) -> pa.Schema:
+    # Fields typed null (no value yet) take their type in new_schema, if any
+    return pa.schema(
+        [
+            pa.field(
+                field.name,
+                new_schema.field(field.name).type,
+                field.nullable,
+                field.metadata,
+            )
+            if pa.types.is_null(field.type)
+            and field.name in new_schema.names
+            and not pa.types.is_null(new_schema.field(field.name).type)
+            else field
+            for field in schema
+        ],
+        metadata=schema.metadata,
+    )
+
+
+def update_predictor_partitions(
+    probe: Any, folder_path: Path, refresh_month: str = None, count_column: str = None
+) -> str:
+    # The computed months replace the stored ones from the refresh month on, then the
+    # probe gets the whole stored predictor back. Predictors normalized by the 99th
+    # percentile of count_column are normalized again over the whole stored period,
+    # otherwise refreshed and stored months would be on different scales.
+    # Returns the last stored month
+    watermark = save_partitions(
+        probe.predictor,
+        folder_path=folder_path,
+        col_date="date",
+        refresh_month=refresh_month,
+    )
+    if refresh_month is not None:
+        probe.predictor = pq.read_table(str(folder_path)).to_pandas()
+        if count_column is not None:
+            probe.predictor = normalize_predictor(
+                probe.predictor, index=list(probe._index), count_column=count_column
+            )
+    return watermark
+
+
+def normalize_predictor(
+    predictor: pd.DataFrame, index: List[str], count_column: str
+) -> pd.DataFrame:
+    # Same normalization as edsteva: c = count / 99th percentile of the count over
+    # the partition, capped to 1 (0 when the percentile is null)
+    q_99 = predictor.groupby(index, dropna=False)[count_column].transform(
+        lambda count: count.quantile(0.99)
+    )
+    predictor = predictor.assign(
+        c=(predictor[count_column] / q_99.where(q_99 != 0)).fillna(0).clip(upper=1)
+    )
+    return predictor
+
+
+def get_cohort_path(export_path: str = None) -> Path:
+    # Outcomes exported by the executors are read where they were written
+    if export_path:
+        return Path(export_path)
+    return BASE_DIR / "data" / "cohort_selection"
+
+
+def scan_partitions(folder_path: Path, columns: List[str] = None):
+    # Lazy scan: only the selected columns are read from disk
+    # (flat monthly files or month=... folders written by the executors)
+    partitions = pl.scan_parquet(folder_path / "**" / "*.parquet")
+    if columns is not None:
+        partitions = partitions.select(
+            [column for column in columns if column in partitions.columns]
+        )
+    return partitions
+
+
 class timemeasure:
     def __init__(self):
         self.t_start = time.time()
@@ -21,15 +186,27 @@ class timemeasure:
         self.timestamp = datetime.datetime.now(datetime.timezone.utc)
         self.event_elapsed_times = {}
         self.step_number = 0
+        self.lock = threading.Lock()
 
     def lap(self, event_name: str):
         t2 = time.time()
         elapsed_time = str(timedelta(seconds=t2 - self.t1))
         self.t1 = time.time()
-        self.event_elapsed_times[
-            "{} - {}".format(self.step_number, event_name)
-        ] = elapsed_time
-        self.step_number += 1
+        self._record(event_name, elapsed_time)
+
+    @contextmanager
+    def measure(self, event_name: str):
+        # Times an event running concurrently with others, laps are left untouched
+        t1 = time.time()
+        yield
+        self._record(event_name, str(timedelta(seconds=time.time() - t1)))
+
+    def _record(self, event_name: str, elapsed_time: str):
+        with self.lock:
+            self.event_elapsed_times[
+                "{} - {}".format(self.step_number, event_name)
+            ] = elapsed_time
+            self.step_number += 1
         logger.info(f"{event_name} took {elapsed_time} seconds")
 
     def stop(self, script_name: str, create_folder: bool = False):
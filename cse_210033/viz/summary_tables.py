@@ -1,10 +1,11 @@
 import pandas as pd
-from edsteva.models.rectangle_function import RectangleFunction
-from edsteva.models.step_function import StepFunction
+import polars as pl
 from IPython.display import display
 
 from cse_210033 import BASE_DIR
+from cse_210033.ehr_modeling.utils.store import scan_estimates
 from cse_210033.statistical_analysis.utils.supplementary_variables import t_test
+from cse_210033.utils import get_cohort_path, scan_partitions
 
 
 def ehr_summary_table():
@@ -18,83 +19,59 @@ def ehr_summary_table():
     )
     ehr_modeling_folder_path = BASE_DIR / "data" / "ehr_modeling"
     models_folder_path = ehr_modeling_folder_path / "models"
-    visit_model_path = models_folder_path / "visit.pickle"
-    condition_model_path = models_folder_path / "condition.pickle"
-    condition_model_per_visit_path = models_folder_path / "condition_per_visit.pickle"
-    note_model_path = models_folder_path / "note.pickle"
-    note_model_per_visit_path = models_folder_path / "note_per_visit.pickle"
-    icu_model_path = models_folder_path / "icu_rectangle.pickle"
 
-    visit_model = StepFunction()
-    visit_model.load(visit_model_path)
-
-    condition_model = StepFunction()
-    condition_model.load(condition_model_path)
-    condition_model_per_visit = StepFunction()
-    condition_model_per_visit.load(condition_model_per_visit_path)
-
-    note_model = StepFunction()
-    note_model.load(note_model_path)
-    note_model_per_visit = StepFunction()
-    note_model_per_visit.load(note_model_per_visit_path)
-
-    icu_model = RectangleFunction()
-    icu_model.load(icu_model_path)
-    model_total = []
-
-    # Filter models
-    model_hospit = visit_model.estimates[
-        (visit_model.estimates.care_site_level == "Hôpital")
-        & (visit_model.estimates.stay_type == "hospitalisés")
-    ].copy()
-    model_total.append(model_hospit)
-    model_emergency = visit_model.estimates[
-        (visit_model.estimates.care_site_level == "Hôpital")
-        & (visit_model.estimates.stay_type == "urgence")
-    ].copy()
-    model_total.append(model_emergency)
-    model_consultation = note_model.estimates[
-        (note_model.estimates.care_site_level == "Unité Fonctionnelle (UF)")
-        & (note_model.estimates.stay_type == "All")
-        & (note_model.estimates.note_type == "consultation")
-    ].copy()
-    model_total.append(model_consultation)
-    model_prescription = note_model_per_visit.estimates[
-        (note_model_per_visit.estimates.care_site_level == "Unité Fonctionnelle (UF)")
-        & (note_model_per_visit.estimates.stay_type == "hospit")
-        & (note_model_per_visit.estimates.note_type == "prescription")
-    ].copy()
-    model_total.append(model_prescription)
-    model_diagnosis = condition_model_per_visit.estimates[
-        (
-            condition_model_per_visit.estimates.care_site_level
-            == "Unité Fonctionnelle (UF)"
-        )
-        & (condition_model_per_visit.estimates.source_system == "ORBIS")
-        & (condition_model_per_visit.estimates.diag_type == "DP_DR")
-        & (condition_model_per_visit.estimates.condition_type == "All")
-    ].copy()
-    model_total.append(model_diagnosis)
-    model_icu = visit_model.estimates[
-        (visit_model.estimates.care_site_level == "Unité d’hébergement (UH)")
-        & (visit_model.estimates.specialties_set == "ICU")
-    ].copy()
-    model_total.append(model_icu)
-    model_icu_rectangle = icu_model.estimates[
-        (icu_model.estimates.care_site_level == "Unité d’hébergement (UH)")
-        & (icu_model.estimates.specialties_set == "ICU")
-    ].copy()
-    model_total.append(model_icu_rectangle)
-    ehr_models = dict(
-        Hospitalization=model_hospit,
-        Emergency=model_emergency,
-        Consultation=model_consultation,
-        Prescription=model_prescription,
-        Diagnosis=model_diagnosis,
-        ICU=model_icu,
-        ICU_rectangle=model_icu_rectangle,
-        Total=pd.concat(model_total),
+    # Filter models (only the estimates of each quality indicator are read)
+    estimates_filters = dict(
+        Hospitalization=(
+            "visit",
+            dict(care_site_level="Hôpital", stay_type="hospitalisés"),
+        ),
+        Emergency=("visit", dict(care_site_level="Hôpital", stay_type="urgence")),
+        Consultation=(
+            "note",
+            dict(
+                care_site_level="Unité Fonctionnelle (UF)",
+                stay_type="All",
+                note_type="consultation",
+            ),
+        ),
+        Prescription=(
+            "note_per_visit",
+            dict(
+                care_site_level="Unité Fonctionnelle (UF)",
+                stay_type="hospit",
+                note_type="prescription",
+            ),
+        ),
+        Diagnosis=(
+            "condition_per_visit",
+            dict(
+                care_site_level="Unité Fonctionnelle (UF)",
+                source_system="ORBIS",
+                diag_type="DP_DR",
+                condition_type="All",
+            ),
+        ),
+        ICU=(
+            "visit",
+            dict(care_site_level="Unité d’hébergement (UH)", specialties_set="ICU"),
+        ),
+        ICU_rectangle=(
+            "icu_rectangle",
+            dict(care_site_level="Unité d’hébergement (UH)", specialties_set="ICU"),
+        ),
+    )
+    estimates = pl.collect_all(
+        [
+            scan_estimates(models_folder_path, model_name, filters=filters)
+            for model_name, filters in estimates_filters.values()
+        ]
     )
+    ehr_models = {
+        index: model_estimates.to_pandas()
+        for index, model_estimates in zip(estimates_filters.keys(), estimates)
+    }
+    ehr_models["Total"] = pd.concat(ehr_models.values())
     for index, model in ehr_models.items():
         error_model = (
             str(round(model.error.mean(), 4))
@@ -120,7 +97,7 @@ def ehr_summary_table():
     return summary_table
 
 
-def cohort_summary_table():
+def cohort_summary_table(export_path: str = None):
     summary_table = pd.DataFrame(
         data={
             "Number of stays": [],
@@ -131,24 +108,32 @@ def cohort_summary_table():
             "Average age at stay (std)": [],
         }
     )
-    cohort_path = BASE_DIR / "data" / "cohort_selection"
+    cohort_path = get_cohort_path(export_path)
     cohort_tables = dict(
-        Cohort=pd.read_pickle(cohort_path / "cohort_visit.pickle"),
-        QI1_Hospitalization=pd.read_pickle(cohort_path / "hospit_visit.pickle"),
-        QI2_Emergency=pd.read_pickle(cohort_path / "emergency_visit.pickle"),
-        QI3_Consultation=pd.read_pickle(cohort_path / "consultation_note.pickle"),
-        QI4_Prescription=pd.read_pickle(cohort_path / "prescription_note.pickle"),
-        QI5_ICU=pd.read_pickle(cohort_path / "icu_visit.pickle"),
-        EI1_Bronchiolitis=pd.read_pickle(
-            cohort_path / "bronchiolitis_condition.pickle"
-        ),
-        EI2_Flu=pd.read_pickle(cohort_path / "flu_condition.pickle"),
-        EI3_Gastroenteritis=pd.read_pickle(
-            cohort_path / "gastroenteritis_condition.pickle"
-        ),
-        EI4_Nasopharyngitis=pd.read_pickle(
-            cohort_path / "nasopharyngitis_condition.pickle"
-        ),
+        Cohort=scan_partitions(cohort_path / "cohort_visit").collect().to_pandas(),
+        QI1_Hospitalization=scan_partitions(cohort_path / "hospit_visit")
+        .collect()
+        .to_pandas(),
+        QI2_Emergency=scan_partitions(cohort_path / "emergency_visit")
+        .collect()
+        .to_pandas(),
+        QI3_Consultation=scan_partitions(cohort_path / "consultation_note")
+        .collect()
+        .to_pandas(),
+        QI4_Prescription=scan_partitions(cohort_path / "prescription_note")
+        .collect()
+        .to_pandas(),
+        QI5_ICU=scan_partitions(cohort_path / "icu_visit").collect().to_pandas(),
+        EI1_Bronchiolitis=scan_partitions(cohort_path / "bronchiolitis_condition")
+        .collect()
+        .to_pandas(),
+        EI2_Flu=scan_partitions(cohort_path / "flu_condition").collect().to_pandas(),
+        EI3_Gastroenteritis=scan_partitions(cohort_path / "gastroenteritis_condition")
+        .collect()
+        .to_pandas(),
+        EI4_Nasopharyngitis=scan_partitions(cohort_path / "nasopharyngitis_condition")
+        .collect()
+        .to_pandas(),
     )
 
     for index, table in cohort_tables.items():
@@ -1,5 +1,6 @@
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from edsteva import improve_performances
 from edsteva.io import HiveData
@@ -10,7 +11,20 @@ from rich import print
 
 from cse_210033 import BASE_DIR
 from cse_210033.cohort_selection import cohort_selection
-from cse_210033.utils import dump_data, timemeasure
+from cse_210033.cohort_selection.utils.export_data import export_partitions
+from cse_210033.cohort_selection.utils.load_data import PrunedHiveData
+from cse_210033.cohort_selection.utils.prepare_df import (
+    get_ghm_tables_to_load,
+    get_tables_to_load,
+)
+from cse_210033.utils import (
+    dump_data,
+    get_refresh_month,
+    read_data,
+    save_partitions,
+    shift_month,
+    timemeasure,
+)
 
 improve_performances()
 app = SparkApp("CSE210033 - Cohort Selection")
@@ -43,9 +57,49 @@ def run(spark, sql, config):
         tables_to_load=load_data_conf["prod_tables_to_load"],
         spark_session=spark,
     )
-    AREM_data = HiveData(
+    # Incremental mode: refresh months from the last saved month minus a look-back
+    cohort_selection_conf = config["cohort_selection"]
+    partition_dates = dict(
+        cohort_visit="cohort_stay_start",
+        **{
+            outcome_name: outcome_conf["partition_date"]
+            for outcome_name, outcome_conf in cohort_selection_conf["outcomes"].items()
+        },
+    )
+    watermark_path = save_folder_path / "watermarks.json"
+    watermarks = (
+        read_data(watermark_path, default={})
+        if cohort_selection_conf["incremental"]
+        else {}
+    )
+    refresh_months = {
+        outcome_name: get_refresh_month(
+            watermarks.get(outcome_name), cohort_selection_conf["look_back_months"]
+        )
+        for outcome_name in partition_dates
+    }
+    if None not in refresh_months.values():
+        # Cohort stays of the look-back are needed to link events of refreshed months
+        cohort_selection_conf["start_date"] = max(
+            cohort_selection_conf["start_date"],
+            shift_month(
+                min(refresh_months.values()),
+                -cohort_selection_conf["look_back_months"],
+            ),
+        )
+        logger.info(
+            "Incremental cohort selection from {}", cohort_selection_conf["start_date"]
+        )
+
+    # Only columns and rows needed by the cohort selection are scanned
+    cohort_data = PrunedHiveData(
+        database_name=load_data_conf["database_name"],
+        tables_to_load=get_tables_to_load(**cohort_selection_conf),
+        spark_session=spark,
+    )
+    AREM_data = PrunedHiveData(
         database_name=load_data_conf["AREM_database_name"],
-        tables_to_load=load_data_conf["GHM_tables_to_load"],
+        tables_to_load=get_ghm_tables_to_load(**cohort_selection_conf),
         spark_session=spark,
     )
     # Time measurement
@@ -69,29 +123,86 @@ def run(spark, sql, config):
     timer.lap(event_name="Count records in all EDS")
 
     # Cohort selection
-    cohort_selection_conf = config["cohort_selection"]
     outcomes = cohort_selection(
-        data=data, prod_data=prod_data, AREM_data=AREM_data, **cohort_selection_conf
+        data=cohort_data,
+        prod_data=prod_data,
+        AREM_data=AREM_data,
+        start_date=cohort_selection_conf["start_date"],
+        end_date=cohort_selection_conf["end_date"],
+        note_source_system=cohort_selection_conf["note_source_system"],
+        person_source_system=cohort_selection_conf["person_source_system"],
+        visit_source_system=cohort_selection_conf["visit_source_system"],
+        ghm_source_system=cohort_selection_conf["ghm_source_system"],
+        condition_source_system=cohort_selection_conf["condition_source_system"],
+        cmd=cohort_selection_conf["cmd"],
+        hospit_stay_type_regex=cohort_selection_conf["hospit_stay_type_regex"],
+        hospit_stay_source_regex=cohort_selection_conf["hospit_stay_source_regex"],
+        condition_transfer_type_regex=cohort_selection_conf[
+            "condition_transfer_type_regex"
+        ],
+        diag_regex=cohort_selection_conf["diag_regex"],
+        outcomes=cohort_selection_conf["outcomes"],
+        cohort_person_broadcast_threshold=cohort_selection_conf[
+            "cohort_person_broadcast_threshold"
+        ],
     )
     # Time measurement
     timer.lap(event_name="Cohort selection query")
 
-    for outcome_name, outcome_df in outcomes.items():
-        outcome_path = save_folder_path / "{}.pickle".format(outcome_name)
-        outcome_name = outcome_name.replace("_", " ")
-        print("Selecting {} stays...".format(outcome_name))
-        if is_koalas(outcome_df):
-            outcome_df = to("pandas", outcome_df)
-        outcome_df.to_pickle(outcome_path)
+    export_path = cohort_selection_conf["export_path"]
+
+    def export_outcome(outcome_name, outcome_df):
+        # Jobs of concurrent outcomes share the FAIR default pool (conf/fairscheduler.xml)
+        # so that small writes are not queued behind large ones
+        refresh_month = refresh_months[outcome_name]
+        outcome_name_log = outcome_name.replace("_", " ")
+        print("Selecting {} stays...".format(outcome_name_log))
+        with timer.measure(event_name="Selecting {} stays".format(outcome_name_log)):
+            if export_path and is_koalas(outcome_df):
+                outcome_path = "{}/{}".format(export_path.rstrip("/"), outcome_name)
+                outcome_shape, watermark = export_partitions(
+                    outcome_df,
+                    path=outcome_path,
+                    col_date=partition_dates[outcome_name],
+                    refresh_month=refresh_month,
+                )
+            else:
+                outcome_path = save_folder_path / outcome_name
+                if is_koalas(outcome_df):
+                    outcome_df = to("pandas", outcome_df)
+                outcome_shape = outcome_df.shape
+                watermark = save_partitions(
+                    outcome_df,
+                    folder_path=outcome_path,
+                    col_date=partition_dates[outcome_name],
+                    refresh_month=refresh_month,
+                )
         logger.info(
-            "{} table has been saved in {}", outcome_name.capitalize(), outcome_path
+            "{} table has been saved in {} from {}",
+            outcome_name_log.capitalize(),
+            outcome_path,
+            refresh_month or "the start",
         )
         logger.info(
-            "{} table has shape {}", outcome_name.capitalize(), outcome_df.shape
+            "{} table has shape {}", outcome_name_log.capitalize(), outcome_shape
         )
-        del outcome_df
-        # Time measurement
-        timer.lap(event_name="Selecting {} stays".format(outcome_name))
+        return watermark
+
+    # Outcomes collected to the driver are exported one at a time so that a single
+    # outcome is held in driver memory
+    with ThreadPoolExecutor(
+        max_workers=cohort_selection_conf["export_concurrency"] if export_path else 1
+    ) as executor:
+        exports = {
+            executor.submit(export_outcome, outcome_name, outcome_df): outcome_name
+            for outcome_name, outcome_df in outcomes.items()
+        }
+        for export in as_completed(exports):
+            watermarks[exports[export]] = export.result()
+            dump_data(watermarks, watermark_path)
+    del outcomes
+    # Time measurement
+    timer.lap(event_name="Export outcomes")
     timer.stop(script_name="cohort_selection")
 
     print("Data has been preprocessed and saved ! :sunglasses:")
@@ -3,16 +3,30 @@ import sys
 
 from edsteva import improve_performances
 from edsteva.io import HiveData
-from edsteva.models.rectangle_function import RectangleFunction
-from edsteva.models.step_function import StepFunction
-from edsteva.probes import ConditionProbe, NoteProbe, VisitProbe
 from edsteva.utils.framework import to
 from edstoolbox import SparkApp
 from loguru import logger
 from rich import print
 
 from cse_210033 import BASE_DIR
-from cse_210033.utils import timemeasure
+from cse_210033.ehr_modeling import (
+    compute_probes,
+    fit_models,
+    get_count_column,
+    load_previous_models,
+)
+from cse_210033.ehr_modeling.utils.store import (
+    save_model,
+    save_partition_hashes,
+    save_probe,
+)
+from cse_210033.utils import (
+    dump_data,
+    get_refresh_month,
+    read_data,
+    timemeasure,
+    update_predictor_partitions,
+)
 
 improve_performances()
 app = SparkApp("CSE210033 - EHR Modeling")
@@ -39,18 +53,6 @@ def run(spark, _, config):
         os.mkdir(models_folder_path)
         print("the folder {} has been created".format(models_folder_path))
 
-    visit_probe_path = probes_folder_path / "visit.pickle"
-    icu_probe_path = probes_folder_path / "icu_rectangle.pickle"
-    condition_probe_path = probes_folder_path / "condition.pickle"
-    condition_probe_per_visit_path = probes_folder_path / "condition_per_visit.pickle"
-    note_probe_path = probes_folder_path / "note.pickle"
-    note_probe_per_visit_path = probes_folder_path / "note_per_visit.pickle"
-    visit_model_path = models_folder_path / "visit.pickle"
-    icu_model_path = models_folder_path / "icu_rectangle.pickle"
-    condition_model_path = models_folder_path / "condition.pickle"
-    condition_per_visit_model_path = models_folder_path / "condition_per_visit.pickle"
-    note_model_path = models_folder_path / "note.pickle"
-    note_per_visit_model_path = models_folder_path / "note_per_visit.pickle"
     # Time measurement
     timer.lap(event_name="Setup config")
 
@@ -110,159 +112,58 @@ def run(spark, _, config):
     # Time measurement
     timer.lap(event_name="Count number of care sites per level")
 
-    # Compute visit probe
-    logger.info("Computing visit probe...")
-    visit_probe = VisitProbe()
-    visit_probe.compute(data=data, **ehr_conf["visit"])
-    logger.info("Visit probe has shape {}", visit_probe.predictor.shape)
-    visit_probe.save(visit_probe_path)
-    logger.info("Visit probe saved in {}", visit_probe_path)
-    # Time measurement
-    timer.lap(event_name="Compute visit probe")
-
-    # Compute ICU probe
-    logger.info("Computing ICU probe...")
-    icu_probe = VisitProbe()
-    icu_probe.compute(data=data, **ehr_conf["icu"])
-    logger.info("ICU probe has shape {}", icu_probe.predictor.shape)
-    icu_probe.save(icu_probe_path)
-    logger.info("ICU probe saved in {}", icu_probe_path)
-    # Time measurement
-    timer.lap(event_name="Compute ICU probe")
-
-    # Compute condition probe per visit
-    logger.info("Computing condition probe per visit...")
-    condition_probe_per_visit = ConditionProbe(
-        completeness_predictor="per_visit_default"
-    )
-    condition_probe_per_visit.compute(
-        data=data,
-        extra_data=AREM_data,
-        **ehr_conf["condition"],
-    )
-    logger.info(
-        "Condition probe per visit has shape {}",
-        condition_probe_per_visit.predictor.shape,
-    )
-    condition_probe_per_visit.save(condition_probe_per_visit_path)
-    logger.info("Condition per visit probe saved in {}", condition_probe_per_visit_path)
-    # Time measurement
-    timer.lap(event_name="Compute condition probe per visit")
-
-    # Compute condition probe per condition
-    logger.info("Computing condition probe per condition...")
-    condition_probe = ConditionProbe(completeness_predictor="per_condition_default")
-    condition_probe.compute(
+    # Compute probes (incremental mode: from the last stored month minus look-back)
+    watermark_path = probes_folder_path / "watermarks.json"
+    watermarks = (
+        read_data(watermark_path, default={}) if ehr_conf["incremental"] else {}
+    )
+    # Probes without a dated month stored are computed in full
+    refresh_months = {
+        probe_name: get_refresh_month(watermark, ehr_conf["look_back_months"])
+        for probe_name, watermark in watermarks.items()
+    }
+    probes = {}
+    for probe_name, probe in compute_probes(
         data=data,
-        extra_data=AREM_data,
-        **ehr_conf["condition"],
-    )
-    logger.info(
-        "Condition probe per condition has shape {}",
-        condition_probe.predictor.shape,
-    )
-    condition_probe.save(condition_probe_path)
-    logger.info("Condition per condition probe saved in {}", condition_probe_path)
-    # Time measurement
-    timer.lap(event_name="Compute condition probe per condition")
-
-    # Compute note per visit probe
-    logger.info("Computing note probe per visit...")
-    note_probe_per_visit = NoteProbe(completeness_predictor="per_visit_default")
-    note_probe_per_visit.compute(
-        data=data,
-        extra_data=prod_data,
-        **ehr_conf["note"],
-    )
-    logger.info(
-        "Note probe per visit has shape {}", note_probe_per_visit.predictor.shape
-    )
-    note_probe_per_visit.save(note_probe_per_visit_path)
-    logger.info("Note probe per visit saved in {}", note_probe_per_visit_path)
-    # Time measurement
-    timer.lap(event_name="Compute note probe per visit")
-
-    # Compute note per note probe
-    logger.info("Computing note probe per note...")
-    note_probe = NoteProbe(completeness_predictor="per_note_default")
-    note_probe.compute(
-        data=data,
-        extra_data=prod_data,
-        **ehr_conf["note"],
-    )
-    logger.info("Note probe per note has shape {}", note_probe.predictor.shape)
-    note_probe.save(note_probe_path)
-    logger.info("Note probe per note saved in {}", note_probe_path)
-    # Time measurement
-    timer.lap(event_name="Compute note probe per note")
-
-    # Fit Step Function model for visit
-    logger.info("Computing visit step function model...")
-    visit_model = StepFunction()
-    visit_model.fit(probe=visit_probe)
-    logger.info("Visit model has shape {}", visit_model.estimates.shape)
-    visit_model.save(visit_model_path)
-    logger.info("Visit model saved in {}", visit_model_path)
-    # Time measurement
-    timer.lap(event_name="Fit Step Function model on visit probe")
-
-    # Fit Rectangle Function model for icu
-    logger.info("Computing ICU rectangle function model...")
-    icu_model = RectangleFunction()
-    icu_model.fit(probe=icu_probe)
-    logger.info("ICU model has shape {}", icu_model.estimates.shape)
-    icu_model.save(icu_model_path)
-    logger.info("ICU model saved in {}", icu_model_path)
-    # Time measurement
-    timer.lap(event_name="Fit Rectangle Function model on ICU probe")
-
-    # Fit Step Function model for condition per visit
-    logger.info("Computing condition step function per visit model...")
-    condition_per_visit_model = StepFunction()
-    condition_per_visit_model.fit(probe=condition_probe_per_visit)
-    logger.info(
-        "Condition per visit model has shape {}",
-        condition_per_visit_model.estimates.shape,
-    )
-    condition_per_visit_model.save(condition_per_visit_model_path)
-    logger.info("Condition per visit model saved in {}", condition_per_visit_model_path)
-    # Time measurement
-    timer.lap(event_name="Fit Step Function model on condition probe per visit")
-
-    # Fit Step Function model for condition per condition
-    logger.info("Computing condition step function per condition model...")
-    condition_model = StepFunction()
-    condition_model.fit(probe=condition_probe)
-    logger.info(
-        "Condition per condition model has shape {}",
-        condition_model.estimates.shape,
-    )
-    condition_model.save(condition_model_path)
-    logger.info("Condition per condition model saved in {}", condition_model_path)
-    # Time measurement
-    timer.lap(event_name="Fit Step Function model on condition probe per condition")
-
-    # Fit Step Function model for note per visit
-    logger.info("Computing note step function per visit model...")
-    note_per_visit_model = StepFunction()
-    note_per_visit_model.fit(probe=note_probe_per_visit)
-    logger.info(
-        "Note per visit model has shape {}", note_per_visit_model.estimates.shape
-    )
-    note_per_visit_model.save(note_per_visit_model_path)
-    logger.info("Note per visit model saved in {}", note_per_visit_model_path)
-    # Time measurement
-    timer.lap(event_name="Fit Step Function model on note probe per visit")
-
-    # Fit Step Function model for note per note
-    logger.info("Computing note step function per note model...")
-    note_model = StepFunction()
-    note_model.fit(probe=note_probe)
-    logger.info("Note per note model has shape {}", note_model.estimates.shape)
-    note_model.save(note_model_path)
-    logger.info("Note per note model saved in {}", note_model_path)
-    # Time measurement
-    timer.lap(event_name="Fit Step Function model on note probe per note")
+        extra_data=dict(condition=AREM_data, note=prod_data),
+        probes=ehr_conf["probes"],
+        parameters=ehr_conf,
+        refresh_months=refresh_months,
+    ):
+        watermarks[probe_name] = update_predictor_partitions(
+            probe,
+            folder_path=probes_folder_path / probe_name,
+            refresh_month=refresh_months.get(probe_name),
+            count_column=get_count_column(ehr_conf["probes"][probe_name]),
+        )
+        dump_data(watermarks, watermark_path)
+        save_probe(probe, probes_folder_path=probes_folder_path, probe_name=probe_name)
+        logger.info("{} probe saved in {}", probe_name, probes_folder_path / probe_name)
+        probes[probe_name] = probe
+        # Time measurement
+        timer.lap(event_name="Compute {} probe".format(probe_name))
+
+    # Fit models
+    previous_models = None
+    if ehr_conf["incremental"]:
+        previous_models = load_previous_models(
+            models=ehr_conf["probes"], models_folder_path=models_folder_path
+        )
+    for model_name, model, partition_hashes in fit_models(
+        probes=probes,
+        models=ehr_conf["probes"],
+        n_jobs=ehr_conf["n_jobs"],
+        previous_models=previous_models,
+    ):
+        save_model(model, models_folder_path=models_folder_path, model_name=model_name)
+        save_partition_hashes(
+            partition_hashes,
+            models_folder_path=models_folder_path,
+            model_name=model_name,
+        )
+        logger.info("{} model saved in {}", model_name, models_folder_path)
+        # Time measurement
+        timer.lap(event_name="Fit {} model".format(model_name))
     timer.stop(script_name="ehr_modeling")
 
     print("EHR models have been computed and saved ! :sunglasses:")
@@ -11,6 +11,7 @@ from loguru import logger
 from rich import print
 
 from cse_210033 import BASE_DIR
+from cse_210033.ehr_modeling.utils.store import load_model, load_probe
 from cse_210033.viz import (
     plot_ehr_context,
     plot_ehr_models,
@@ -35,51 +36,30 @@ def main(config_name: str = "config.cfg"):
     # Load Probes
     ehr_modeling_folder_path = BASE_DIR / "data" / "ehr_modeling"
     probes_folder_path = ehr_modeling_folder_path / "probes"
-    visit_probe_path = probes_folder_path / "visit.pickle"
-    condition_probe_path = probes_folder_path / "condition.pickle"
-    condition_probe_per_visit_path = probes_folder_path / "condition_per_visit.pickle"
-    note_probe_path = probes_folder_path / "note.pickle"
-    note_probe_per_visit_path = probes_folder_path / "note_per_visit.pickle"
-    icu_probe_path = probes_folder_path / "icu_rectangle.pickle"
-
-    visit_probe = VisitProbe()
-    visit_probe.load(visit_probe_path)
-    icu_probe = VisitProbe()
-    icu_probe.load(icu_probe_path)
-
-    condition_probe = ConditionProbe()
-    condition_probe.load(condition_probe_path)
-    condition_probe_per_visit = ConditionProbe()
-    condition_probe_per_visit.load(condition_probe_per_visit_path)
-
-    note_probe = NoteProbe()
-    note_probe.load(note_probe_path)
-    note_probe_per_visit = NoteProbe()
-    note_probe_per_visit.load(note_probe_per_visit_path)
+    visit_probe = load_probe(VisitProbe, probes_folder_path, "visit")
+    icu_probe = load_probe(VisitProbe, probes_folder_path, "icu_rectangle")
+
+    condition_probe = load_probe(ConditionProbe, probes_folder_path, "condition")
+    condition_probe_per_visit = load_probe(
+        ConditionProbe, probes_folder_path, "condition_per_visit"
+    )
+
+    note_probe = load_probe(NoteProbe, probes_folder_path, "note")
+    note_probe_per_visit = load_probe(NoteProbe, probes_folder_path, "note_per_visit")
 
     # Load Models
     models_folder_path = ehr_modeling_folder_path / "models"
-    visit_model_path = models_folder_path / "visit.pickle"
-    condition_model_path = models_folder_path / "condition.pickle"
-    condition_per_visit_model_path = models_folder_path / "condition_per_visit.pickle"
-    note_model_path = models_folder_path / "note.pickle"
-    note_per_visit_model_path = models_folder_path / "note_per_visit.pickle"
-    icu_model_path = models_folder_path / "icu_rectangle.pickle"
-
-    visit_model = StepFunction()
-    visit_model.load(visit_model_path)
-    icu_model = RectangleFunction()
-    icu_model.load(icu_model_path)
-
-    condition_model = StepFunction()
-    condition_model.load(condition_model_path)
-    condition_per_visit_model = StepFunction()
-    condition_per_visit_model.load(condition_per_visit_model_path)
-
-    note_model = StepFunction()
-    note_model.load(note_model_path)
-    note_per_visit_model = StepFunction()
-    note_per_visit_model.load(note_per_visit_model_path)
+    visit_model = load_model(StepFunction, models_folder_path, "visit")
+    icu_model = load_model(RectangleFunction, models_folder_path, "icu_rectangle")
+
+    condition_per_visit_model = load_model(
+        StepFunction, models_folder_path, "condition_per_visit"
+    )
+
+    note_model = load_model(StepFunction, models_folder_path, "note")
+    note_per_visit_model = load_model(
+        StepFunction, models_folder_path, "note_per_visit"
+    )
 
     # Load post_processed data
     statistical_analysis_path = BASE_DIR / "data" / "statistical_analysis"
@@ -1,26 +1,23 @@
 import os
 import sys
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import polars as pl
 import typer
 from confection import Config
-from edsteva.models.rectangle_function import RectangleFunction
-from edsteva.models.step_function import StepFunction
 from loguru import logger
 from rich import print
 
 from cse_210033 import BASE_DIR
-from cse_210033.statistical_analysis import statistical_analysis
+from cse_210033.ehr_modeling.utils.store import scan_estimates
+from cse_210033.statistical_analysis import get_event_columns, statistical_analysis
 from cse_210033.statistical_analysis.utils.complete_source import (
     filter_unstable_cs_from_event_df,
 )
-from cse_210033.statistical_analysis.utils.supplementary_variables import (
-    add_care_site,
-    add_mcd,
-)
-from cse_210033.utils import dump_data, timemeasure
+from cse_210033.statistical_analysis.utils.supplementary_variables import add_mcd
+from cse_210033.utils import dump_data, get_cohort_path, scan_partitions, timemeasure
 
 warnings.filterwarnings("ignore")
 
@@ -33,42 +30,27 @@ def main(config_name: str = "config.cfg"):
     if config["debug"]["debug"]:
         logger.remove()
         logger.add(sys.stderr, level="DEBUG")
+    export_path = config["cohort_selection"]["export_path"]
     config = config["statistical_analysis"]
     thresholds = config["thresholds"]
+    if config["streaming_chunk_size"]:
+        pl.Config.set_streaming_chunk_size(config["streaming_chunk_size"])
     # Time measurement
     timer.lap(event_name="Setup config")
 
-    # Load Models
+    # Load model estimates (memory-mapped Arrow files)
     ehr_modeling_folder_path = BASE_DIR / "data" / "ehr_modeling"
     models_folder_path = ehr_modeling_folder_path / "models"
-    visit_model_path = models_folder_path / "visit.pickle"
-    icu_model_path = models_folder_path / "icu_rectangle.pickle"
-    condition_model_per_visit_path = models_folder_path / "condition_per_visit.pickle"
-    note_model_path = models_folder_path / "note.pickle"
-    note_model_per_visit_path = models_folder_path / "note_per_visit.pickle"
-
-    visit_model = StepFunction()
-    visit_model.load(visit_model_path)
-
-    icu_model = RectangleFunction()
-    icu_model.load(icu_model_path)
-
-    condition_model_per_visit = StepFunction()
-    condition_model_per_visit.load(condition_model_per_visit_path)
-
-    note_model = StepFunction()
-    note_model.load(note_model_path)
-
-    note_model_per_visit = StepFunction()
-    note_model_per_visit.load(note_model_per_visit_path)
-
-    ehr_estimates = dict(
-        visit=visit_model.estimates,
-        icu_rectangle=icu_model.estimates,
-        condition=condition_model_per_visit.estimates,
-        note=note_model.estimates,
-        note_per_visit=note_model_per_visit.estimates,
-    )
+    ehr_estimates = {
+        ehr_functionality: scan_estimates(models_folder_path, model_name).collect()
+        for ehr_functionality, model_name in dict(
+            visit="visit",
+            icu_rectangle="icu_rectangle",
+            condition="condition_per_visit",
+            note="note",
+            note_per_visit="note_per_visit",
+        ).items()
+    }
     # Time measurement
     timer.lap(event_name="Load models")
 
@@ -79,96 +61,105 @@ def main(config_name: str = "config.cfg"):
     # Time measurement
     timer.lap(event_name="Load care site count")
 
-    # Load cohort data
-    cohort_path = BASE_DIR / "data" / "cohort_selection"
-    cohort_visit = pl.from_pandas(pd.read_pickle(cohort_path / "cohort_visit.pickle"))
-    outcomes = dict(
-        hospit_visit=pl.from_pandas(
-            pd.read_pickle(cohort_path / "hospit_visit.pickle")
-        ),
-        emergency_visit=pl.from_pandas(
-            pd.read_pickle(cohort_path / "emergency_visit.pickle")
-        ),
-        consultation_note=pl.from_pandas(
-            pd.read_pickle(cohort_path / "consultation_note.pickle")
-        ),
-        prescription_note=pl.from_pandas(
-            pd.read_pickle(cohort_path / "prescription_note.pickle")
-        ),
-        bronchiolitis_condition=pl.from_pandas(
-            pd.read_pickle(cohort_path / "bronchiolitis_condition.pickle")
-        ),
-        flu_condition=pl.from_pandas(
-            pd.read_pickle(cohort_path / "flu_condition.pickle")
-        ),
-        gastroenteritis_condition=pl.from_pandas(
-            pd.read_pickle(cohort_path / "gastroenteritis_condition.pickle")
-        ),
-        nasopharyngitis_condition=pl.from_pandas(
-            pd.read_pickle(cohort_path / "nasopharyngitis_condition.pickle")
-        ),
-        icu_visit=pl.from_pandas(pd.read_pickle(cohort_path / "icu_visit.pickle")),
-        icu_visit_rectangle=pl.from_pandas(
-            pd.read_pickle(cohort_path / "icu_visit.pickle")
-        ),
+    # Load cohort data (only the columns used by the analysis are read)
+    cohort_path = get_cohort_path(export_path)
+    cohort_visit = scan_partitions(
+        cohort_path / "cohort_visit",
+        columns=[
+            "visit_cohort_id",
+            "person_id",
+            "care_site_id",
+            "cohort_stay_start",
+            "cohort_stay_end",
+            "stay_type",
+            "CMD_code",
+            "CMD",
+            "sub_cohort",
+        ],
+    )
+    cohort_visit = cohort_visit.filter(pl.col("cohort_stay_end").is_not_null())
+    if not config["streaming"]:
+        # In streaming mode the monthly partitions are only read by the analyses
+        cohort_visit = cohort_visit.collect()
+    outcome_tables = dict(
+        hospit_visit="hospit_visit",
+        emergency_visit="emergency_visit",
+        consultation_note="consultation_note",
+        prescription_note="prescription_note",
+        bronchiolitis_condition="bronchiolitis_condition",
+        flu_condition="flu_condition",
+        gastroenteritis_condition="gastroenteritis_condition",
+        nasopharyngitis_condition="nasopharyngitis_condition",
+        icu_visit="icu_visit",
+        icu_visit_rectangle="icu_visit",
     )
+    outcomes = {}
+    loaded_tables = {}
+    for outcome_name, table_name in outcome_tables.items():
+        event_columns = get_event_columns(**config[outcome_name])
+        table_key = (table_name, *event_columns)
+        if table_key not in loaded_tables:
+            loaded_tables[table_key] = scan_partitions(
+                cohort_path / table_name, columns=event_columns
+            ).collect()
+        outcomes[outcome_name] = loaded_tables[table_key]
     # Time measurement
     timer.lap(event_name="Load cohort data")
 
     # Filter cohort visit
-    cohort_visit = cohort_visit.select(
-        [
-            pl.col("visit_cohort_id"),
-            pl.col("person_id"),
-            pl.col("care_site_id"),
-            pl.col("cohort_stay_start"),
-            pl.col("cohort_stay_end"),
-            pl.col("stay_type"),
-            pl.col("CMD_code"),
-            pl.col("CMD"),
-            pl.col("sub_cohort"),
-        ]
-    ).filter(pl.col("cohort_stay_end").is_not_null())
     cohort_cs_count, cohort_visit = filter_unstable_cs_from_event_df(
         event_df=cohort_visit,
-        ehr_estimates=pl.from_pandas(ehr_estimates["visit"]),
+        ehr_estimates=ehr_estimates["visit"],
         start_observation_date=config["cohort_start_date"],
         care_site_level="Hôpital",
         stay_type="hospitalisés",
         visit_col="visit_cohort_id",
     )
-    cohort_visit = add_care_site(cohort_visit=cohort_visit)
-    _, cohort_visit_all = add_mcd(cohort_visit=cohort_visit)
+    # "All" care sites and "00 ALL" MCD rows are aggregated by the key functions
+    # (see totals)
+    cohort_visit_all = add_mcd(cohort_visit=cohort_visit)
     cohort_visit_all = cohort_visit_all.sort("cohort_stay_end")
     # Time measurement
     timer.lap(event_name="Filter cohort stays")
 
-    # Outcomes
-    cs_count_outcomes = []
-    for outcome_name, outcome_df in outcomes.items():
+    # Outcomes run in threads: polars releases the GIL and every input is shared
+    def analyse_outcome(outcome_name, outcome_df):
         outcome_config = config[outcome_name]
-        cs_count_outcome, result_outcome = statistical_analysis(
-            cohort_visit_all=cohort_visit_all,
-            cs_count=cs_count,
-            event_df=outcome_df,
-            thresholds=thresholds,
-            ehr_estimates=pl.from_pandas(
-                ehr_estimates[outcome_config["ehr_functionality"]]
-            ),
-            **outcome_config,
-        )
-        cs_count_outcome["outcome_name"] = outcome_name
-        cs_count_outcomes.append(cs_count_outcome)
-        result_outcome.to_pickle(
-            BASE_DIR / "data" / "statistical_analysis" / "{}.pkl".format(outcome_name)
-        )
-        print("{} has been saved".format(outcome_name))
-        # Time measurement
-        timer.lap(
+        with timer.measure(
             event_name="Statistical analysis for {}".format(
                 outcome_config["event_name"]
             )
+        ):
+            cs_count_outcome, result_outcome = statistical_analysis(
+                cohort_visit_all=cohort_visit_all,
+                cs_count=cs_count,
+                event_df=outcome_df,
+                thresholds=thresholds,
+                error_quantiles=config["error_quantiles"],
+                c_0_quantiles=config["c_0_quantiles"],
+                quantiles_sample_size=config["quantiles_sample_size"],
+                totals=config["totals"],
+                streaming=config["streaming"],
+                ehr_estimates=ehr_estimates[outcome_config["ehr_functionality"]],
+                **outcome_config,
+            )
+            cs_count_outcome["outcome_name"] = outcome_name
+            result_outcome.to_pickle(
+                BASE_DIR
+                / "data"
+                / "statistical_analysis"
+                / "{}.pkl".format(outcome_name)
+            )
+        print("{} has been saved".format(outcome_name))
+        return cs_count_outcome
+
+    with ThreadPoolExecutor(max_workers=config["n_jobs"]) as executor:
+        # Results are gathered in config order whatever the completion order
+        cs_count_outcomes = list(
+            executor.map(analyse_outcome, outcomes.keys(), outcomes.values())
         )
+    # Time measurement
+    timer.lap(event_name="Statistical analysis")
     cs_count_summary = pd.concat(cs_count_outcomes)
     cs_count_summary["cohort_hospital_count"] = cohort_cs_count
     cs_count_summary.to_pickle(
@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cse_210033.utils import (
+    dump_data,
+    get_refresh_month,
+    read_data,
+    save_partitions,
+    update_predictor_partitions,
+)
+
+
+def test_empty_outcome_watermark_round_trip(tmp_path):
+    outcome = pd.DataFrame(
+        {"visit_occurrence_id": pd.Series([], dtype="int64")}
+    ).assign(cohort_stay_start=pd.Series([], dtype="datetime64[ns]"))
+    watermarks = dict(
+        empty=save_partitions(
+            outcome, folder_path=tmp_path / "empty", col_date="cohort_stay_start"
+        )
+    )
+    dump_data(watermarks, tmp_path / "watermarks.json")
+
+    watermarks = read_data(tmp_path / "watermarks.json", default={})
+    assert watermarks == dict(empty=None)
+    assert get_refresh_month(watermarks["empty"], look_back_months=3) is None
+    assert get_refresh_month(watermarks.get("missing"), look_back_months=3) is None
+
+
+def test_refresh_month_looks_back_from_watermark():
+    assert get_refresh_month("2020-02-01", look_back_months=3) == "2019-11-01"
+
+
+INDEX = ["care_site_id", "stay_type"]
+
+
+def edsteva_predictor(n_visit: pd.DataFrame):
+    # edsteva per_visit_default, over the months of n_visit only:
+    # c = min(n_visit / 99th percentile of n_visit per care site and stay type, 1)
+    predictor = n_visit.copy()
+    predictor["c"] = 0.0
+    for _, rows in predictor.groupby(INDEX):
+        q_99 = np.quantile(rows.n_visit, 0.99)
+        predictor.loc[rows.index, "c"] = np.minimum(rows.n_visit / q_99, 1)
+    return SimpleNamespace(_index=INDEX, predictor=predictor)
+
+
+def test_refreshed_month_matches_full_recompute(tmp_path):
+    dates = pd.date_range("2020-01-01", "2020-12-01", freq="MS")
+    n_visit = pd.DataFrame(
+        {
+            "care_site_id": ["1"] * len(dates) + ["2"] * len(dates),
+            "stay_type": "hospitalisés",
+            "date": [*dates, *dates],
+            "n_visit": [*range(10, 10 + len(dates)), *range(len(dates), 0, -1)],
+        }
+    )
+    refresh_month = "2020-12-01"
+    stale = n_visit.assign(
+        n_visit=n_visit.n_visit.where(n_visit.date < refresh_month, 0)
+    )
+    update_predictor_partitions(edsteva_predictor(stale), folder_path=tmp_path)
+
+    # The probe is only computed from the refresh month on
+    probe = edsteva_predictor(n_visit[n_visit.date >= refresh_month])
+    watermark = update_predictor_partitions(
+        probe,
+        folder_path=tmp_path,
+        refresh_month=refresh_month,
+        count_column="n_visit",
+    )
+
+    assert watermark == refresh_month
+    predictor = probe.predictor.sort_values(INDEX + ["date"]).reset_index(drop=True)
+    expected = edsteva_predictor(n_visit).predictor
+    pd.testing.assert_frame_equal(predictor, expected, check_dtype=False)
+    # Care site 2, June 2020: 7 visits, 99th percentile of 1..12 = 1 + 0.99 * 11
+    june = predictor[(predictor.care_site_id == "2") & (predictor.date == "2020-06-01")]
+    assert june.c.item() == pytest.approx(7 / 11.89)